@@ -0,0 +1,393 @@
+"""bench.py
+
+Microbenchmarks for the ccl evaluators. Usage:
+
+  python bench.py [--mode MODE ...] [--repeat N]
+  python bench.py --parse FUNCTIONS [--flat]
+  python bench.py --lex FUNCTIONS
+  python bench.py --cache FUNCTIONS
+  python bench.py --chain TERMS
+  python bench.py --suite [--mode MODE ...] [--json FILE]
+  python bench.py --compare OLD.json NEW.json [--threshold FRACTION]
+"""
+
+import argparse
+import hashlib
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+import ccl
+
+
+CALLS = {
+    'fallthrough': r"""
+var Id = \ x
+  x
+""",
+    'return': r"""
+var Id = \ x
+  return x
+""",
+    'early-return': r"""
+var Id = \ x
+  while true
+    return x
+  nil
+""",
+}
+# Workloads from the programs in old/hr and old/tests, in today's dialect:
+# methods such as n.Add(1) in place of operators, and linked objects in
+# place of indexed lists. Each is run with the value it must produce.
+PROGRAMS = {
+    # old/hr/extra-long-factorials.ccl: big numbers as lists of digits.
+    'factorial': (r"""
+var Digit = \ value next
+  var digit = Create()
+  digit.value = value
+  digit.next = next
+  digit
+
+var Times = \ x n
+  var total = 0, i = 0
+  while i.LessThan(n)
+    total = total.Add(x)
+    i = i.Add(1)
+  total
+
+var MultiplySmall = \ head n
+  var digit = head, last = nil, carry = 0, z = 0
+  while digit.NotEqual(nil) or (0).LessThan(carry)
+    if digit.Equal(nil)
+      digit = Digit(0, nil)
+      last.next = digit
+    z = Times(digit.value, n).Add(carry)
+    carry = 0
+    while (9).LessThan(z)
+      z = z.Subtract(10)
+      carry = carry.Add(1)
+    digit.value = z
+    last = digit
+    digit = digit.next
+  head
+
+var ToString = \ head
+  var s = "", digit = head
+  while digit.NotEqual(nil)
+    s = "%s%s".Format([digit.value, s])
+    digit = digit.next
+  s
+
+var Factorial = \ n
+  var head = Digit(1, nil), i = 2
+  while i.LessThanOrEqualTo(n)
+    head = MultiplySmall(head, i)
+    i = i.Add(1)
+  ToString(head)
+
+Factorial(40)
+""", '815915283247897734345611269596115894272000000000'),
+
+    # old/hr/staircase.ccl: string building.
+    'staircase': (r"""
+var Staircase = \ n
+  var s = "", i = 1
+  while i.LessThanOrEqualTo(n)
+    s = "%s%s%s\n".Format([s, " ".Multiply(n.Subtract(i)), "#".Multiply(i)])
+    i = i.Add(1)
+  s
+
+Staircase(1000).Size()
+""", '1001000'),
+
+    # old/hr/simple-array-sum.ccl: an arithmetic loop.
+    'sum': (r"""
+var Sum = \ n
+  var total = 0, i = 0
+  while i.LessThan(n)
+    total = total.Add(i).Subtract(1)
+    i = i.Add(1)
+  total
+
+Sum(30000)
+""", '449955000'),
+
+    # old/tests/basic.ccl: list pushes.
+    'push': (r"""
+var Fill = \ n
+  var xs = [], i = 0
+  while i.LessThan(n)
+    xs.Push(i)
+    i = i.Add(1)
+  xs
+
+Fill(30000).String().Size()
+""", '198890'),
+
+    'fib': (r"""
+var Fib = \ n
+  if n.LessThan(2)
+    return n
+  Fib(n.Subtract(1)).Add(Fib(n.Subtract(2)))
+
+Fib(18)
+""", '2584'),
+
+    # old/tests/basic.ccl: objects with methods.
+    'objects': (r"""
+var Counter = \
+  var this = Create()
+  this.count = 0
+  this.Increment = \
+    this.count = this.count.Add(1)
+  this
+
+var counter = Counter(), i = 0
+while i.LessThan(20000)
+  counter.Increment()
+  i = i.Add(1)
+counter.count
+""", '20000'),
+}
+
+# Size of the generated source lexed and parsed by the suite.
+SUITE_FUNCTIONS = 500
+
+
+LOOP = r"""
+var i = 0
+while i.LessThan(%d)
+  Id(i)
+  i = i.Add(1)
+"""
+
+
+FUNCTION = r"""
+var F%(i)d = \ n s
+  var i = 0
+  var out = []
+  while i.LessThan(n) and s.Size().LessThan(%(i)d)
+    if i.Equal(%(i)d) or s.Equal("f%(i)d")
+      break
+    out.Push(s.Multiply(i).Add("\t"))
+    i = i.Add(1)
+  return [i, out, %(i)d.5, "done"]
+"""
+
+
+def GenerateSource(functions):
+  """A large ccl module of functions with loops, calls and literals."""
+  return ''.join(FUNCTION % {'i': i} for i in range(functions))
+
+
+def BenchCalls(mode, repeat, iterations):
+  results = []
+  for name, function in sorted(CALLS.items()):
+    source = function + LOOP % iterations
+    seconds = min(timeit.repeat(
+        lambda: ccl.Run(source, '<bench>', mode), number=1, repeat=repeat))
+    results.append((name, seconds))
+  return results
+
+
+def BenchParse(functions, flat=False):
+  """
+  Seconds to Parse a generated source, and the peak traced bytes while
+  parsing and the bytes the result keeps.
+  """
+  source = GenerateSource(functions)
+  seconds = min(timeit.repeat(
+      lambda: ccl.Parse(source, '<bench>', flat), number=1, repeat=3))
+  tracemalloc.start()
+  try:
+    tree = ccl.Parse(source, '<bench>', flat)
+    kept, peak = tracemalloc.get_traced_memory()
+    del tree
+  finally:
+    tracemalloc.stop()
+  return len(source), seconds, peak, kept
+
+
+def BenchLex(functions, lex):
+  """Throughput of a lexer on a generated source in MB/s."""
+  source = GenerateSource(functions)
+  seconds = min(timeit.repeat(lambda: lex(source, '<bench>'), number=1, repeat=3))
+  return len(source) / seconds / 1e6
+
+
+def BenchCache(functions):
+  """Seconds to run a generated source with an empty and a primed parse cache."""
+  source = GenerateSource(functions)
+  cold = []
+  warm = []
+  for _ in range(3):
+    directory = tempfile.mkdtemp()
+    try:
+      cold.append(min(timeit.repeat(
+          lambda: ccl.Run(source, '<bench>', cache=directory), number=1, repeat=1)))
+      warm.append(min(timeit.repeat(
+          lambda: ccl.Run(source, '<bench>', cache=directory), number=1, repeat=3)))
+    finally:
+      shutil.rmtree(directory)
+  return len(source), min(cold), min(warm)
+
+
+def BenchChain(terms):
+  """Seconds to Parse one expression of terms operands joined by and and or."""
+  source = ''.join(
+      'a%d %s ' % (i, 'or' if i % 3 else 'and') for i in range(terms - 1)) + 'z'
+  seconds = min(timeit.repeat(lambda: ccl.Parse(source, '<bench>'), number=1, repeat=3))
+  return seconds
+
+
+def Timings(function, repeat, warmup):
+  """Seconds of repeat calls of function, after warmup untimed ones."""
+  for _ in range(warmup):
+    function()
+  return timeit.repeat(function, number=1, repeat=repeat)
+
+
+def BenchSuite(modes, repeat, warmup):
+  """
+  The source and timings of each program in PROGRAMS in each mode, and of
+  lexing and parsing a generated source, by benchmark name.
+  """
+  results = dict()
+  for mode in modes:
+    for name, (source, expected) in sorted(PROGRAMS.items()):
+      result = str(ccl.Run(source, name, mode))
+      if result != expected:
+        raise AssertionError('%s in %s mode gave %s, not %s' % (name, mode, result, expected))
+      results['%s/%s' % (mode, name)] = source, Timings(
+          lambda: ccl.Run(source, name, mode), repeat, warmup)
+  source = GenerateSource(SUITE_FUNCTIONS)
+  results['lex'] = source, Timings(lambda: ccl.Lex(source, '<bench>'), repeat, warmup)
+  results['parse'] = source, Timings(lambda: ccl.Parse(source, '<bench>'), repeat, warmup)
+  return results
+
+
+def SuiteJson(results):
+  """
+  results with the fastest and median run of each, a digest of the source
+  each ran, and what ran them.
+  """
+  return {
+      'python': sys.version,
+      'interpreter': ccl.InterpreterVersion().hex(),
+      'benchmarks': dict((name, {
+          'source': hashlib.sha256(source.encode('utf-8')).hexdigest()[:16],
+          'min': min(runs),
+          'median': statistics.median(runs),
+          'runs': runs,
+      }) for name, (source, runs) in results.items()),
+  }
+
+
+def Compare(old, new, threshold):
+  """
+  Lines comparing the fastest runs of two SuiteJson results, and whether
+  any benchmark got slower by more than threshold, a fraction.
+  """
+  lines = ['%-24s %10s %10s %8s\n' % ('benchmark', 'old ms', 'new ms', 'change')]
+  regressed = False
+  old = old['benchmarks']
+  new = new['benchmarks']
+  for name in sorted(set(old) & set(new)):
+    if old[name]['source'] != new[name]['source']:
+      lines.append('%-24s changed source\n' % name)
+      continue
+    before = old[name]['min']
+    after = new[name]['min']
+    change = after / before - 1
+    flag = ''
+    if change > threshold:
+      flag = ' slower'
+      regressed = True
+    elif change < -threshold:
+      flag = ' faster'
+    lines.append('%-24s %10.3f %10.3f %+7.1f%%%s\n' % (
+        name, before * 1000, after * 1000, change * 100, flag))
+  for name in sorted(set(old) ^ set(new)):
+    lines.append('%-24s only in %s\n' % (name, 'old' if name in old else 'new'))
+  return lines, regressed
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[2])
+  parser.add_argument('--mode', action='append', choices=sorted(ccl.MODES))
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--iterations', type=int, default=20000)
+  parser.add_argument('--parse', type=int, metavar='FUNCTIONS',
+                      help='parse a generated source instead of running calls')
+  parser.add_argument('--flat', action='store_true', help='parse into a FlatTree')
+  parser.add_argument('--lex', type=int, metavar='FUNCTIONS',
+                      help='lex a generated source instead of running calls')
+  parser.add_argument('--cache', type=int, metavar='FUNCTIONS',
+                      help='run a generated source with a cold and a warm parse cache')
+  parser.add_argument('--chain', type=int, metavar='TERMS',
+                      help='parse a chain of TERMS and/or operands at a few sizes')
+  parser.add_argument('--suite', action='store_true',
+                      help='time the programs in PROGRAMS and lexing and parsing')
+  parser.add_argument('--warmup', type=int, default=1, help='untimed runs before each benchmark')
+  parser.add_argument('--json', metavar='FILE', help='write suite results to FILE')
+  parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                      help='compare two --json files and fail if any benchmark got slower')
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help='slowdown, as a fraction, that --compare reports')
+  args = parser.parse_args()
+
+  if args.compare:
+    files = []
+    for path in args.compare:
+      with open(path) as f:
+        files.append(json.load(f))
+    lines, regressed = Compare(files[0], files[1], args.threshold)
+    sys.stdout.write(''.join(lines))
+    sys.exit(1 if regressed else 0)
+
+  if args.suite:
+    results = SuiteJson(BenchSuite(args.mode or sorted(ccl.MODES), args.repeat, args.warmup))
+    for name, result in sorted(results['benchmarks'].items()):
+      sys.stdout.write('%-24s min %10.3f ms median %10.3f ms\n' % (
+          name, result['min'] * 1000, result['median'] * 1000))
+    if args.json:
+      with open(args.json, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.write('\n')
+    return
+
+  if args.chain:
+    for terms in (args.chain // 10, args.chain // 2, args.chain):
+      seconds = BenchChain(terms)
+      sys.stdout.write('chain %8d terms %8.3f ms %6.2f us/term\n' % (
+          terms, seconds * 1000, seconds / terms * 1e6))
+    return
+
+  if args.cache:
+    size, cold, warm = BenchCache(args.cache)
+    sys.stdout.write('cache %d bytes cold %8.3f ms warm %8.3f ms\n' % (
+        size, cold * 1000, warm * 1000))
+    return
+
+  if args.lex:
+    for lex in (ccl.Lex, ccl.ReferenceLex):
+      sys.stdout.write('%-12s %8.2f MB/s\n' % (lex.__name__, BenchLex(args.lex, lex)))
+    return
+
+  if args.parse:
+    size, seconds, peak, kept = BenchParse(args.parse, args.flat)
+    sys.stdout.write('parse %d bytes %8.3f ms peak %.1f MB kept %.1f MB\n' % (
+        size, seconds * 1000, peak / 1e6, kept / 1e6))
+    return
+
+  for mode in args.mode or sorted(ccl.MODES):
+    for name, seconds in BenchCalls(mode, args.repeat, args.iterations):
+      sys.stdout.write('%-10s calls/%-14s %8.3f ms\n' % (mode, name, seconds * 1000))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,15 +1,84 @@
 """ccl.py"""
 
+import bisect
+import gc
+import hashlib
+import json
+import marshal
+import os
+import re
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from operator import attrgetter
+from types import FunctionType, MethodType
 
 
-class Origin(object):
+class SourceFile(object):
+  """
+  A source string and the offsets where its lines start, shared by every
+  token and Origin in it so that positions are resolved by bisection.
+
+  The string can grow by Append as a stream is lexed. Its pieces are only
+  joined when the string is asked for, and line starts are found once for
+  each part of it, so neither is redone for every chunk.
+  """
 
-  def __init__(self, filename, string, position):
+  __slots__ = ('filename', 'pieces', 'line_starts', 'scanned')
+
+  def __init__(self, filename, string=''):
     self.filename = filename
-    self.string = string
+    self.pieces = [string]
+    self.line_starts = [0]
+    # How much of the string has been searched for line starts.
+    self.scanned = 0
+
+  def Append(self, chunk):
+    self.pieces.append(chunk)
+
+  @property
+  def string(self):
+    if len(self.pieces) > 1:
+      self.pieces = [''.join(self.pieces)]
+    return self.pieces[0]
+
+  def LineStarts(self):
+    string = self.string
+    if self.scanned < len(string):
+      starts = self.line_starts
+      p = string.find('\n', self.scanned)
+      while p != -1:
+        starts.append(p + 1)
+        p = string.find('\n', p + 1)
+      self.scanned = len(string)
+    return self.line_starts
+
+  def LineIndex(self, position):
+    return bisect.bisect_right(self.LineStarts(), position) - 1
+
+  def Origin(self, position):
+    return Origin(self.filename, None, position, self)
+
+
+class Origin(object):
+
+  __slots__ = ('source', 'position')
+
+  def __init__(self, filename, string, position, source=None):
+    self.source = source or SourceFile(filename, string)
     self.position = position
 
+  @property
+  def filename(self):
+    return self.source.filename
+
+  @property
+  def string(self):
+    return self.source.string
+
   def LocationMessage(self):
     return 'in %s on line %d column %d\n%s\n%s*\n' % (
         self.filename,
@@ -19,7 +88,7 @@ class Origin(object):
         ' ' * (self.ColumnNumber() - 1))
 
   def LineNumber(self):
-    return 1 + self.string.count('\n', 0, self.position)
+    return 1 + self.source.LineIndex(self.position)
 
   def ColumnNumber(self):
     return 1 + self.position - self.LineStart()
@@ -28,19 +97,28 @@ class Origin(object):
     return self.string[self.LineStart():self.LineEnd()]
 
   def LineStart(self):
-    return self.string.rfind('\n', 0, self.position) + 1
+    return self.source.LineStarts()[self.source.LineIndex(self.position)]
 
   def LineEnd(self):
-    p = self.string.find('\n', self.position)
-    return len(self.string) if p == -1 else p
+    starts = self.source.LineStarts()
+    index = self.source.LineIndex(self.position)
+    return starts[index + 1] - 1 if index + 1 < len(starts) else len(self.string)
 
 
 class Token(object):
+  """A token carries its location as an offset into source, not an Origin."""
 
-  def __init__(self, type, value=None, origin=None):
+  __slots__ = ('type', 'value', 'source', 'position')
+
+  def __init__(self, type, value=None, source=None, position=0):
     self.type = type
     self.value = value
-    self.origin = origin
+    self.source = source
+    self.position = position
+
+  @property
+  def origin(self):
+    return None if self.source is None else self.source.Origin(self.position)
 
   def __eq__(self, other):
     return self.type == other.type and self.value == other.value
@@ -71,18 +149,216 @@ class LexError(Exception):
     super(LexError, self).__init__(message + '\n' + origin.LocationMessage())
 
 
+# One token per match, including the whitespace and comments before it. A
+# newline also takes the blank and comment only lines after it and the
+# indent of the next line. Within brackets that is all just whitespace.
+TOKEN_PATTERN = re.compile(r"""
+    (?:[^\S\n]+|\#[^\n]*)*
+    (?:
+        (?P<name>(?!r["'])[^\W\d]\w*)
+      | (?P<number>[0-9]+(?:\.[0-9]*)?|\.[0-9]+)
+      | (?P<symbol>%s)
+      | (?P<string>
+            r(?P<raw>
+                \"\"\".*?\"\"\"
+              | '''.*?'''
+              | "(?!"")[^"]*"
+              | '(?!'')[^']*')
+          | (?P<cooked>
+                \"\"\"(?:\\.|[^\\])*?\"\"\"
+              | '''(?:\\.|[^\\])*?'''
+              | "(?!"")(?:\\.|[^\\"])*"
+              | '(?!'')(?:\\.|[^\\'])*'))
+      | (?P<unterminated>r?(?:\"\"\"|'''|"|'))
+      | (?P<newline>
+            \n
+            (?:[^\S\n]*(?:\#[^\n]*)?\n)*
+            (?P<indent>[^\S\n]*)
+            (?:\#[^\n]*)?)
+      | (?P<end>\Z)
+      | (?P<unrecognized>\S*)
+    )
+""" % '|'.join(re.escape(symbol) for symbol in sorted(SYMBOLS, key=len, reverse=True)),
+    re.VERBOSE | re.DOTALL)
+
+ESCAPE_PATTERN = re.compile(
+    r'\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}|[0-7]{1,3}|.)',
+    re.DOTALL)
+
+ESCAPES = {
+    '\\': '\\', "'": "'", '"': '"', '\n': '',
+    'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v',
+}
+
+OPENERS = ('(', '{', '[')
+CLOSERS = (')', '}', ']')
+
+
+def Unescape(match):
+  escape = match.group(1)
+  if escape in ESCAPES:
+    return ESCAPES[escape]
+  elif escape[0] in 'xuU' and len(escape) > 1:
+    return chr(int(escape[1:], 16))
+  elif escape[0] == 'N' and len(escape) > 1:
+    import unicodedata
+    return unicodedata.lookup(escape[2:-1])
+  elif escape[0] in '01234567':
+    return chr(int(escape, 8))
+  return match.group(0)
+
+
+def StringValue(text):
+  """Value of a string literal token's text, without eval."""
+  raw = text[0] == 'r'
+  if raw:
+    text = text[1:]
+  quote = 3 if text[:3] in ('"""', "'''") else 1
+  value = text[quote:-quote]
+  if not raw and '\\' in value:
+    value = ESCAPE_PATTERN.sub(Unescape, value)
+  return value
+
+
+# Characters read at a time by LexStream from a file object.
+CHUNK_SIZE = 1 << 16
+
+
 def Lex(string, filename):
+  return list(LexStream((string,), filename))
+
+
+def LexStream(stream, filename):
+  """
+  Generate Tokens from a file object or an iterable of strings.
+
+  Each token is one TOKEN_PATTERN match. Input is read a chunk at a time
+  and only the unconsumed tail is kept for scanning; a match that reaches
+  the end of what has been read so far, or an unterminated string, is
+  retried once more input arrives.
+
+  Produces the same tokens as ReferenceLex, the original character by
+  character lexer, but converts literals without eval.
+  """
+
+  if hasattr(stream, 'read'):
+    chunks = iter(lambda: stream.read(CHUNK_SIZE), '')
+  else:
+    chunks = iter(stream)
+
+  source = SourceFile(filename)
+  keywords = frozenset(KEYWORDS)
+  depth = 0
+  indent_stack = ['']
+  buffer = ''
+  offset = 0
+  done = False
+  match = TOKEN_PATTERN.scanner(buffer).match
+
+  def ErrorOrigin(position):
+    # Read through the end of the offending line so the message can show it.
+    if not done:
+      for chunk in chunks:
+        source.Append(chunk)
+        if '\n' in chunk:
+          break
+    return source.Origin(position)
+
+  while True:
+    m = match()
+
+    if not done and (m.end() >= len(buffer) or m.lastgroup == 'unterminated'):
+      start = m.start()
+      chunk = next(chunks, None)
+      while chunk == '':
+        chunk = next(chunks, None)
+      if chunk is None:
+        done = True
+        chunk = ''
+      else:
+        source.Append(chunk)
+      buffer = buffer[start:] + chunk
+      offset += start
+      match = TOKEN_PATTERN.scanner(buffer).match
+      continue
+
+    kind = m.lastgroup
+
+    if kind == 'name':
+      word = m.group(kind)
+      if word in keywords:
+        yield Token(word, None, source, offset + m.start(kind))
+      else:
+        yield Token('Name', word, source, offset + m.start(kind))
+    elif kind == 'symbol':
+      symbol = m.group(kind)
+      if symbol in OPENERS:
+        depth += 1
+      elif symbol in CLOSERS:
+        depth -= 1
+      yield Token(symbol, None, source, offset + m.start(kind))
+    elif kind == 'newline':
+      if depth:
+        continue
+      yield Token('Newline', None, source, offset + m.start(kind))
+
+      if m.end() < len(buffer):
+        indent = m.group('indent')
+        j = offset + m.start('indent')
+        if indent == indent_stack[-1]:
+          pass
+        elif indent.startswith(indent_stack[-1]):
+          yield Token('Indent', None, source, j)
+          yield Token('Newline', None, source, j)
+          indent_stack.append(indent)
+        elif indent in indent_stack:
+          while indent != indent_stack[-1]:
+            yield Token('Dedent', None, source, j)
+            yield Token('Newline', None, source, j)
+            indent_stack.pop()
+        else:
+          raise LexError('Invalid indent: ' + repr(indent), ErrorOrigin(j))
+    elif kind == 'number':
+      text = m.group(kind)
+      value = float(text) if '.' in text else int(text)
+      yield Token('Number', value, source, offset + m.start(kind))
+    elif kind == 'string':
+      yield Token('String', StringValue(m.group(kind)), source, offset + m.start(kind))
+    elif kind == 'end':
+      break
+    elif kind == 'unterminated':
+      raise LexError(
+          "Missing quotes for: " + m.group(kind).lstrip('r'),
+          ErrorOrigin(offset + m.start(kind)))
+    else:
+      raise LexError(
+          "Unrecognized token: " + m.group(kind),
+          ErrorOrigin(offset + m.start(kind)))
+
+  j = offset + len(buffer)
+
+  while indent_stack[-1] != '':
+    yield Token('Dedent', None, source, j)
+    indent_stack.pop()
+
+  yield Token('End', None, source, j)
+
+
+def ReferenceLex(string, filename):
+  """The original character by character lexer, kept to check Lex against."""
+
   tokens = []
   depth = 0
   s = string
   i = 0
   indent_stack = ['']
+  source = SourceFile(filename, string)
 
   def MakeOrigin():
-    return Origin(filename, s, j)
+    return source.Origin(j)
 
   def MakeToken(type_, value=None):
-    return Token(type_, value, MakeOrigin())
+    return Token(type_, value, source, j)
 
   while True:
     while i < len(s) and ((s[i].isspace() and (depth or s[i] != '\n')) or s[i] == '#'):
@@ -178,17 +454,79 @@ def Lex(string, filename):
   return tokens
 
 
+# Node types, in the order of the small int kinds that are dispatched on.
+NODE_TYPES = (
+    'Module',
+    'Name',
+    'String',
+    'Number',
+    'List',
+    'Function',
+    'Block',
+    'break',
+    'var',
+    'if',
+    'while',
+    'return',
+    'Call',
+    'MethodCall',
+    'Arguments',
+    'GetAttribute',
+    'SetAttribute',
+    'and',
+    'or',
+    'Assign',
+)
+
+(
+    MODULE_NODE,
+    NAME_NODE,
+    STRING_NODE,
+    NUMBER_NODE,
+    LIST_NODE,
+    FUNCTION_NODE,
+    BLOCK_NODE,
+    BREAK_NODE,
+    VAR_NODE,
+    IF_NODE,
+    WHILE_NODE,
+    RETURN_NODE,
+    CALL_NODE,
+    METHOD_CALL_NODE,
+    ARGUMENTS_NODE,
+    GET_ATTRIBUTE_NODE,
+    SET_ATTRIBUTE_NODE,
+    AND_NODE,
+    OR_NODE,
+    ASSIGN_NODE,
+) = range(len(NODE_TYPES))
+
+KINDS = dict((type_, kind) for kind, type_ in enumerate(NODE_TYPES))
+
+
 class Node(object):
+  """
+  A parsed expression. kind is the index of type in NODE_TYPES.
 
-  def __init__(self, type, value, children, origin=None):
-    self.type = type
-    self.value = value
-    self.children = children
-    self.origin = origin
+  Node types with a fixed number of children are made as a subclass that
+  keeps them in named fields, like test, body and orelse for an if, and
+  whose children is a list view of those fields. The rest keep a list.
+  Each subclass stores the children given in its own __init__.
+  """
+
+  __slots__ = ('type', 'kind', 'value', 'origin')
 
+  def __new__(cls, type, value, children, origin=None):
     if origin is not None and not isinstance(origin, Origin):
       raise TypeError('origin must be None or Origin but found ' + str(type(origin)))
 
+    self = object.__new__(NODE_CLASSES.get(type, ListNode))
+    self.type = type
+    self.kind = KINDS.get(type)
+    self.value = value
+    self.origin = origin
+    return self
+
   def __repr__(self):
     return 'Node(%r, %r, %r)' % (self.type, self.value, self.children)
 
@@ -196,13 +534,353 @@ class Node(object):
     return (self.type, self.value, self.children) == (other.type, other.value, other.children)
 
 
+class ListNode(Node):
+
+  __slots__ = ('children',)
+
+  def __init__(self, type, value, children, origin=None):
+    self.children = children
+
+
+def Fields(*names):
+  """
+  A children property viewing the named fields. Only the last field may be
+  left out, and is then None.
+  """
+  if len(names) == 1:
+    name, = names
+
+    def GetChildren(node):
+      return [getattr(node, name)]
+
+    def SetChildren(node, children):
+      child, = children
+      setattr(node, name, child)
+  else:
+    get = attrgetter(*names)
+    last = names[-1]
+
+    def GetChildren(node):
+      children = list(get(node))
+      if children[-1] is None:
+        children.pop()
+      return children
+
+    def SetChildren(node, children):
+      if len(children) == len(names) - 1:
+        setattr(node, last, None)
+      elif len(children) != len(names):
+        raise TypeError('%s takes %d children' % (node.type, len(names)))
+      for name, child in zip(names, children):
+        setattr(node, name, child)
+
+  return property(GetChildren, SetChildren)
+
+
+class LeafNode(Node):
+  """Name, String, Number and break."""
+
+  __slots__ = ()
+
+  def __init__(self, type, value, children, origin=None):
+    if children:
+      raise TypeError('%s takes no children' % type)
+
+  @property
+  def children(self):
+    return []
+
+  @children.setter
+  def children(self, children):
+    if children:
+      raise TypeError('%s takes no children' % self.type)
+
+
+class FunctionNode(Node):
+  __slots__ = ('body',)
+  children = Fields('body')
+
+  def __init__(self, type, value, children, origin=None):
+    self.body, = children
+
+
+class IfNode(Node):
+  __slots__ = ('test', 'body', 'orelse')
+  children = Fields('test', 'body', 'orelse')
+
+  def __init__(self, type, value, children, origin=None):
+    if len(children) == 2:
+      self.test, self.body = children
+      self.orelse = None
+    else:
+      self.test, self.body, self.orelse = children
+
+
+class WhileNode(Node):
+  __slots__ = ('test', 'body')
+  children = Fields('test', 'body')
+
+  def __init__(self, type, value, children, origin=None):
+    self.test, self.body = children
+
+
+class ReturnNode(Node):
+  __slots__ = ('operand',)
+  children = Fields('operand')
+
+  def __init__(self, type, value, children, origin=None):
+    self.operand, = children
+
+
+class CallNode(Node):
+  __slots__ = ('function', 'arguments')
+  children = Fields('function', 'arguments')
+
+  def __init__(self, type, value, children, origin=None):
+    self.function, self.arguments = children
+
+
+class MethodCallNode(Node):
+  __slots__ = ('receiver', 'arguments')
+  children = Fields('receiver', 'arguments')
+
+  def __init__(self, type, value, children, origin=None):
+    self.receiver, self.arguments = children
+
+
+class GetAttributeNode(Node):
+  __slots__ = ('owner',)
+  children = Fields('owner')
+
+  def __init__(self, type, value, children, origin=None):
+    self.owner, = children
+
+
+class SetAttributeNode(Node):
+  __slots__ = ('owner', 'rhs')
+  children = Fields('owner', 'rhs')
+
+  def __init__(self, type, value, children, origin=None):
+    self.owner, self.rhs = children
+
+
+class BinaryNode(Node):
+  """and and or."""
+  __slots__ = ('lhs', 'rhs')
+  children = Fields('lhs', 'rhs')
+
+  def __init__(self, type, value, children, origin=None):
+    self.lhs, self.rhs = children
+
+
+class AssignNode(Node):
+  __slots__ = ('rhs',)
+  children = Fields('rhs')
+
+  def __init__(self, type, value, children, origin=None):
+    self.rhs, = children
+
+
+NODE_CLASSES = {
+    'Name': LeafNode,
+    'String': LeafNode,
+    'Number': LeafNode,
+    'break': LeafNode,
+    'Function': FunctionNode,
+    'if': IfNode,
+    'while': WhileNode,
+    'return': ReturnNode,
+    'Call': CallNode,
+    'MethodCall': MethodCallNode,
+    'GetAttribute': GetAttributeNode,
+    'SetAttribute': SetAttributeNode,
+    'and': BinaryNode,
+    'or': BinaryNode,
+    'Assign': AssignNode,
+}
+
+
 class ParseError(Exception):
 
   def __init__(self, message, origin):
     super(ParseError, self).__init__(message + '\n' + origin.LocationMessage())
 
 
-def Parse(string, filename):
+class FlatTree(object):
+  """
+  A parsed tree kept in parallel array columns instead of a Node object
+  per node, for modules too large to hold as objects.
+
+  Nodes are numbered in preorder from the root at 0. For node i, kinds[i]
+  is its kind, values[i] the index of its value in constants or -1 for
+  None, firsts[i] and nexts[i] its first child and next sibling or -1, and
+  positions[i] the position of its origin in source or -1.
+  """
+
+  __slots__ = ('kinds', 'values', 'firsts', 'nexts', 'positions', 'constants', 'pool', 'source')
+
+  def __init__(self, source):
+    self.kinds = array('B')
+    self.values = array('i')
+    self.firsts = array('i')
+    self.nexts = array('i')
+    self.positions = array('i')
+    self.constants = []
+    self.pool = dict()
+    self.source = source
+
+  def __len__(self):
+    return len(self.kinds)
+
+  def Constant(self, value):
+    """The index of value in constants, adding it if it is new."""
+    if value is None:
+      return -1
+    if type(value) is list:
+      value = tuple(value)
+    key = (type(value), value)
+    index = self.pool.get(key)
+    if index is None:
+      index = self.pool[key] = len(self.constants)
+      self.constants.append(value)
+    return index
+
+  def Append(self, node, parent=-1, after=-1):
+    """
+    Add node and its descendants as the child of parent that follows
+    after, or as its first child if after is -1. Returns node's index.
+    """
+    kinds = self.kinds
+    values = self.values
+    firsts = self.firsts
+    nexts = self.nexts
+    positions = self.positions
+    constant = self.Constant
+    root = len(kinds)
+    lasts = {parent: after}
+    stack = [(node, parent)]
+    while stack:
+      node, parent = stack.pop()
+      index = len(kinds)
+      kinds.append(node.kind)
+      value = node.value
+      values.append(-1 if value is None else constant(value))
+      firsts.append(-1)
+      nexts.append(-1)
+      origin = node.origin
+      positions.append(-1 if origin is None else origin.position)
+      previous = lasts.get(parent, -1)
+      if previous >= 0:
+        nexts[previous] = index
+      elif parent >= 0:
+        firsts[parent] = index
+      lasts[parent] = index
+      children = node.children
+      if children:
+        stack.extend([(child, index) for child in reversed(children)])
+    return root
+
+  def Children(self, index):
+    child = self.firsts[index]
+    while child >= 0:
+      yield child
+      child = self.nexts[child]
+
+  def Type(self, index):
+    return NODE_TYPES[self.kinds[index]]
+
+  def Value(self, index):
+    value = self.values[index]
+    if value < 0:
+      return None
+    value = self.constants[value]
+    return list(value) if type(value) is tuple else value
+
+  def Origin(self, index):
+    position = self.positions[index]
+    return None if position < 0 else self.source.Origin(position)
+
+  def Node(self, index=0):
+    """Build the Node tree rooted at index."""
+    # A subtree is the run of nodes from its root to its last descendant,
+    # so it is built children first by going through that run backwards.
+    end = index
+    while self.firsts[end] >= 0:
+      end = self.firsts[end]
+      while self.nexts[end] >= 0:
+        end = self.nexts[end]
+    firsts = self.firsts
+    nexts = self.nexts
+    values = self.values
+    constants = self.constants
+    positions = self.positions
+    source = self.source
+    nodes = [None] * (end + 1 - index)
+    # The tree has no cycles, so the collector would only slow the build down.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+      for i in range(end, index - 1, -1):
+        children = []
+        child = firsts[i]
+        while child >= 0:
+          children.append(nodes[child - index])
+          child = nexts[child]
+        value = values[i]
+        if value < 0:
+          value = None
+        else:
+          value = constants[value]
+          if type(value) is tuple:
+            value = list(value)
+        position = positions[i]
+        origin = None if position < 0 else Origin(None, None, position, source)
+        nodes[i - index] = Node(NODE_TYPES[self.kinds[i]], value, children, origin)
+    finally:
+      if enabled:
+        gc.enable()
+    return nodes[0]
+
+  def Format(self, index=0):
+    """An outline of the tree at index, one node a line indented by depth."""
+    lines = []
+    stack = [(index, 0)]
+    while stack:
+      index, depth = stack.pop()
+      line = '  ' * depth + NODE_TYPES[self.kinds[index]]
+      value = self.Value(index)
+      if value is not None:
+        line += ' ' + repr(value)
+      lines.append(line)
+      stack.extend(reversed([(child, depth + 1) for child in self.Children(index)]))
+    return '\n'.join(lines) + '\n'
+
+  def ToBytes(self):
+    """The tree, without its source, as one bytes object for FromBytes."""
+    return marshal.dumps((
+        sys.byteorder, self.kinds.tobytes(), self.values.tobytes(), self.firsts.tobytes(),
+        self.nexts.tobytes(), self.positions.tobytes(), tuple(self.constants)))
+
+  @classmethod
+  def FromBytes(cls, data, source):
+    byteorder, kinds, values, firsts, nexts, positions, constants = marshal.loads(data)
+    if byteorder != sys.byteorder:
+      raise ValueError('tree was saved on a %s endian machine' % byteorder)
+    tree = cls(source)
+    tree.kinds.frombytes(kinds)
+    tree.values.frombytes(values)
+    tree.firsts.frombytes(firsts)
+    tree.nexts.frombytes(nexts)
+    tree.positions.frombytes(positions)
+    if not len(tree.kinds) == len(tree.values) == len(tree.firsts) == len(tree.nexts) == len(
+        tree.positions):
+      raise ValueError('tree columns differ in length')
+    tree.constants = list(constants)
+    tree.pool = dict(((type(value), value), i) for i, value in enumerate(tree.constants))
+    return tree
+
+
+def Parse(string, filename, flat=False):
   """
   Parse node types:
 
@@ -218,19 +896,36 @@ def Parse(string, filename):
     while
     return
     Call
+    MethodCall
     Arguments
     GetAttribute
     SetAttribute
     and
     or
     Assign
+
+  string may also be a file object, which is lexed as it is read, or a
+  list of Tokens that Lex has already made from it.
+
+  If flat, the result is a FlatTree, into which each top level expression
+  is moved as soon as it is parsed so that only one is held as Nodes.
   """
 
-  toks = Lex(string, filename)
+  if isinstance(string, list):
+    toks = iter(string)
+  else:
+    toks = LexStream((string,) if isinstance(string, str) else string, filename)
+
+  # Tokens are pulled from the lexer into window as the parser looks ahead.
+  # window[i[0]] is the next token, and one consumed token is kept before
+  # it for Peek(-1).
+  window = []
   i = [0]
 
   def Peek(lookahead=0):
-    return toks[i[0]+lookahead]
+    while len(window) <= i[0] + lookahead:
+      window.append(next(toks))
+    return window[i[0] + lookahead]
 
   def At(type_, origin=None, lookahead=0):
     if Peek(lookahead).type == type_:
@@ -239,8 +934,11 @@ def Parse(string, filename):
       return True
 
   def GetToken():
-    tok = toks[i[0]]
+    tok = Peek()
     i[0] += 1
+    if i[0] > 64:
+      del window[:i[0] - 1]
+      i[0] = 1
     return tok
 
   def Consume(type_, origin=None):
@@ -256,8 +954,24 @@ def Parse(string, filename):
     while Consume('Newline') or Consume(';'):
       pass
 
-  def Expression():
-    return AssignExpression()
+  # Each rule is a generator that yields Expression when it needs one parsed
+  # and is sent the Node back. ParseRule runs them from an explicit stack,
+  # so how deeply a program nests is not limited by Python's stack.
+
+  def ParseRule(rule):
+    stack = [rule()]
+    value = None
+    while True:
+      try:
+        request = stack[-1].send(value)
+      except StopIteration as e:
+        stack.pop()
+        if not stack:
+          return e.value
+        value = e.value
+      else:
+        stack.append(request())
+        value = None
 
   def MakeNodeFromToken(token):
     return Node(token.type, token.value, [], token.origin)
@@ -269,7 +983,7 @@ def Parse(string, filename):
     elif Consume('[', origin):
       exprs = []
       while not Consume(']'):
-        exprs.append(Expression())
+        exprs.append((yield Expression))
         Consume(',')
       return Node('List', None, exprs, origin[0])
     elif Consume('\\', origin):
@@ -279,20 +993,20 @@ def Parse(string, filename):
         Consume(',')
       dot_origin = [None]
       if Consume('.', dot_origin):
-        body = Node('return', None, [Expression()], dot_origin[0])
+        body = Node('return', None, [(yield Expression)], dot_origin[0])
       else:
         EatExpressionDelimiters()
-        body = Expression()
+        body = yield Expression
       return Node('Function', args, [body], origin[0])
     elif Consume('(', origin):
-      expr = Expression()
+      expr = yield Expression
       Expect(')')
       return expr
     elif Consume('Indent', origin):
       exprs = []
       EatExpressionDelimiters()
       while not Consume('Dedent'):
-        exprs.append(Expression())
+        exprs.append((yield Expression))
         EatExpressionDelimiters()
       return Node('Block', None, exprs, origin[0])
     elif Consume('break', origin):
@@ -303,85 +1017,140 @@ def Parse(string, filename):
       while At('Name'):
         names.append(GetToken().value)
         if Consume('='):
-          values.append(Expression())
+          values.append((yield Expression))
         else:
           values.append(Node('Name', 'nil', [], origin[0]))
         Consume(',')
       return Node('var', names, values, origin[0])
     elif Consume('if', origin):
-      exprs = [Expression()] # test
+      exprs = [(yield Expression)] # test
       EatExpressionDelimiters()
-      exprs.append(Expression()) # body
+      exprs.append((yield Expression)) # body
       EatExpressionDelimiters()
       if Consume('else'):
         EatExpressionDelimiters()
-        exprs.append(Expression()) # else
+        exprs.append((yield Expression)) # else
       elif Peek(-1).type in (';', 'Newline'): # TODO: Find more elegant solution.
         i[0] -= 1
       return Node('if', None, exprs, origin[0])
     elif Consume('while', origin):
-      exprs = [Expression()] # test
+      exprs = [(yield Expression)] # test
       EatExpressionDelimiters()
-      exprs.append(Expression()) # body
+      exprs.append((yield Expression)) # body
       return Node('while', None, exprs, origin[0])
     elif Consume('return', origin):
-      return Node('return', None, [Expression()], origin[0])
+      return Node('return', None, [(yield Expression)], origin[0])
     raise ParseError('Expected Expression but found %s' % (Peek().type,), Peek().origin)
 
   def PostfixExpression():
-    expr = PrimaryExpression()
+    if At('Name') or At('String') or At('Number'):
+      expr = MakeNodeFromToken(GetToken())
+    else:
+      expr = yield from PrimaryExpression()
     while True:
       origin = [None]
       if Consume('(', origin):
         args = []
         while not Consume(')'):
-          args.append(Expression())
+          args.append((yield Expression))
           Consume(',')
         if At('\\'):
-          args.append(PrimaryExpression())
-        expr = Node('Call', None, [expr, Node('Arguments', None, args, expr.origin)], origin[0])
+          args.append((yield from PrimaryExpression()))
+        if expr.kind == GET_ATTRIBUTE_NODE:
+          # x.f(...) calls the method directly instead of binding it first.
+          expr = Node('MethodCall', expr.value, [
+              expr.owner, Node('Arguments', None, args, expr.origin)], origin[0])
+        else:
+          expr = Node('Call', None, [expr, Node('Arguments', None, args, expr.origin)], origin[0])
       elif Consume('.', origin):
         name = Expect('Name').value
         if Consume('='):
-          expr = Node('SetAttribute', name, [expr, Expression()], origin[0])
+          expr = Node('SetAttribute', name, [expr, (yield Expression)], origin[0])
         else:
           expr = Node('GetAttribute', name, [expr], origin[0])
       else:
         break
     return expr
 
-  def AndExpression():
-    expr = PostfixExpression()
-    origin = [None]
-    while Consume('and', origin):
-      expr = Node('and', None, [expr, AndExpression()], origin[0])
-    return expr
+  def Expression():
+    """
+    Assignments and chains of and and or, which bind tighter to the right:
+    a = b = c or d and e is a = (b = (c or (d and e))). The operands are
+    read in one loop and the right nested Nodes built from the end.
+    """
+    targets = []
+    while At('Name') and At('=', None, 1):
+      origin = [None]
+      name = Expect('Name', origin).value
+      Expect('=')
+      targets.append((name, origin[0]))
 
-  def OrExpression():
-    expr = AndExpression()
-    origin = [None]
-    while Consume('or', origin):
-      expr = Node('or', None, [expr, OrExpression()], origin[0])
+    expr = yield from PostfixExpression()
+    if At('and') or At('or'):
+      expr = yield from Chain(expr)
+
+    for name, origin in reversed(targets):
+      expr = Node('Assign', name, [expr], origin)
     return expr
 
-  def AssignExpression():
-    if At('Name') and At('=', None, 1):
+  def Chain(expr):
+    # Each group is a run of operands joined by and; groups are joined by or.
+    groups = [[expr]]
+    ands = [[]]
+    ors = []
+    while True:
       origin = [None]
-      name = Expect('Name', origin).value
-      Expect('=')
-      return Node('Assign', name, [AssignExpression()], origin[0])
-    return OrExpression()
+      if Consume('and', origin):
+        ands[-1].append(origin[0])
+      elif Consume('or', origin):
+        ors.append(origin[0])
+        groups.append([])
+        ands.append([])
+      else:
+        break
+      groups[-1].append((yield from PostfixExpression()))
+
+    expr = None
+    for operands, origins, or_origin in reversed(list(zip(groups, ands, [None] + ors))):
+      term = operands[-1]
+      for operand, origin in zip(reversed(operands[:-1]), reversed(origins)):
+        term = Node('and', None, [operand, term], origin)
+      expr = term if expr is None else Node('or', None, [term, expr], next_or)
+      next_or = or_origin
+    return expr
 
-  exprs = []
-  EatExpressionDelimiters()
-  while not At('End'):
-    exprs.append(Expression())
+  def Module():
+    exprs = []
+    if flat:
+      tree = FlatTree(None)
+      tree.Append(Node('Module', None, []))
+      last = -1
     EatExpressionDelimiters()
+    while not At('End'):
+      if flat:
+        last = tree.Append((yield Expression), 0, last)
+      else:
+        exprs.append((yield Expression))
+      EatExpressionDelimiters()
+    if not flat:
+      return Node('Module', None, exprs, exprs[0].origin if exprs else Expect('End').origin)
+    end = Expect('End').origin
+    tree.source = end.source
+    first = tree.firsts[0]
+    tree.positions[0] = end.position if first < 0 else tree.positions[first]
+    return tree
 
-  return Node('Module', None, exprs, exprs[0].origin if exprs else Expect('End').origin)
+  return ParseRule(Module)
 
 
 class Object(object):
+  """
+  Base of the ccl values that are not Python values. Numbers, strings and
+  booleans are plain Python ints, floats, strs and bools, whose methods
+  are in METHODS.
+  """
+
+  __slots__ = ()
 
   def XXPrint(self):
     print(self)
@@ -391,10 +1160,10 @@ class Object(object):
     return self.XXInspect()
 
   def XXInspect(self):
-    return String('<Object %d>' % id(self))
+    return '<Object %d>' % id(self)
 
   def XXEqual(self, other):
-    return Bool(id(self) == id(other))
+    return self is other
 
   def XXLessThanOrEqualTo(self, other):
     return self.XXLessThan(other) or self.XXEqual(other)
@@ -415,126 +1184,278 @@ class Object(object):
     return self.__nonzero__()
 
   def __nonzero__(self):
-    return self.XXBool().value
+    return self.XXBool()
 
   def __str__(self):
-    return self.XXString().value
+    return self.XXString()
 
   def __repr__(self):
-    return self.XXInspect().value
+    return self.XXInspect()
 
 class Nil(Object):
 
+  __slots__ = ()
+
   def XXString(self):
-    return String('nil')
+    return 'nil'
 
   def XXBool(self):
-    return false
+    return False
 
 nil = Nil()
 
 
-class WrapedObject(Object):
+class ValueMethods(object):
+  """
+  Methods shared by the builtin values that are Python values. The classes
+  below are never made: their functions are collected into METHODS and
+  called with the value as self.
+  """
 
-  def __init__(self, value):
-    self.value = value
+  def XXPrint(self):
+    print(ToString(self))
+    return self
+
+  def XXString(self):
+    return str(self)
+
+  def XXInspect(self):
+    return repr(self)
 
   def XXBool(self):
-    return true if self.value else false
+    return bool(self)
 
   def XXEqual(self, other):
-    return type(self) == type(other) and self.value == other.value
+    return type(self) is type(other) and self == other
 
+  def XXNotEqual(self, other):
+    return not METHODS[type(self)]['XXEqual'](self, other)
 
-class Bool(WrapedObject):
 
-  def __init__(self, value):
-    self.value = value
+class BoolMethods(ValueMethods):
 
   def XXString(self):
-    return String('true' if self.value else 'false')
+    return 'true' if self else 'false'
 
-  def XXBool(self):
-    return self
 
-true = Bool(True)
-false = Bool(False)
+NUMBER_TYPES = (int, float)
 
 
-class Number(WrapedObject):
+class NumberMethods(ValueMethods):
 
-  def __init__(self, value):
-    self.value = value
+  def XXEqual(self, other):
+    return type(other) in NUMBER_TYPES and self == other
 
   def XXAdd(self, other):
-    if isinstance(other, Number):
-      return Number(self.value + other.value)
-    raise Exception((other.type, other))
+    if type(other) not in NUMBER_TYPES:
+      raise CclError('Can only Number.Add with other numbers')
+    return self + other
 
   def XXSubtract(self, other):
-    if isinstance(other, Number):
-      return Number(self.value - other.value)
-    raise Exception((other.type, other))
+    if type(other) not in NUMBER_TYPES:
+      raise CclError('Can only Number.Subtract with other numbers')
+    return self - other
 
   def XXLessThan(self, other):
-    if not isinstance(other, Number):
+    if type(other) not in NUMBER_TYPES:
       raise CclError('Can only Number.LessThan with other numbers')
-    return Bool(self.value < other.value)
+    return self < other
 
-  def XXString(self):
-    return String(str(self.value))
+  def XXLessThanOrEqualTo(self, other):
+    if type(other) not in NUMBER_TYPES:
+      raise CclError('Can only Number.LessThanOrEqualTo with other numbers')
+    return self <= other
 
+  def XXGreaterThan(self, other):
+    if type(other) not in NUMBER_TYPES:
+      raise CclError('Can only Number.GreaterThan with other numbers')
+    return self > other
 
-class String(WrapedObject):
+  def XXGreaterThanOrEqualTo(self, other):
+    if type(other) not in NUMBER_TYPES:
+      raise CclError('Can only Number.GreaterThanOrEqualTo with other numbers')
+    return self >= other
 
-  def __init__(self, value):
-    self.value = value
+
+class StringMethods(ValueMethods):
 
   def XXString(self):
     return self
 
   def XXSize(self):
-    return len(self.value)
+    return len(self)
 
   def XXSlice(self, lower, upper):
-    return self.value[lower.value:upper.value]
+    return self[lower:upper]
 
   def XXGet(self, i):
-    return self.value[i.value]
+    return self[i]
 
   def XXFormat(self, args):
-    return self.value % tuple(RevertValue(args))
+    return self % tuple(RevertValue(args))
 
   def XXCount(self, item, lower=None, upper=None):
-    return self.value.count(item.value, lower.value, upper.value)
+    return self.count(item, lower, upper)
 
   def XXMultiply(self, n):
-    return self.value * n.value
+    return self * n
+
+
+def MethodTable(methods):
+  """The XX functions of a methods class and its bases, by name."""
+  table = dict()
+  for cls in reversed(methods.__mro__):
+    table.update((name, function) for name, function in vars(cls).items()
+                 if name.startswith('XX'))
+  return table
+
+
+# Method tables by the exact type of the value, since bool is an int.
+METHODS = {
+    bool: MethodTable(BoolMethods),
+    int: MethodTable(NumberMethods),
+    float: MethodTable(NumberMethods),
+    str: MethodTable(StringMethods),
+}
+
+# What ccl calls the builtin types that are Python values.
+TYPE_NAMES = {bool: 'Bool', int: 'Number', float: 'Number', str: 'String'}
+
+
+def Attribute(owner, attr):
+  """
+  The attribute attr of owner, with its 'XX' prefix. Methods of Python
+  values come from METHODS, bound to the value. Raises AttributeError.
+  """
+  methods = METHODS.get(type(owner))
+  if methods is None:
+    return getattr(owner, attr)
+  function = methods.get(attr)
+  if function is None:
+    raise AttributeError(attr)
+  return MethodType(function, owner)
+
+
+def ToString(value):
+  """The str that value.String() returns."""
+  methods = METHODS.get(type(value))
+  if methods is None:
+    return value.XXString()
+  return methods['XXString'](value)
+
+
+def Equal(value, other):
+  """What value.Equal(other) returns."""
+  methods = METHODS.get(type(value))
+  if methods is None:
+    return value.XXEqual(other)
+  return methods['XXEqual'](value, other)
+
+
+def TypeName(value):
+  return TYPE_NAMES.get(type(value)) or type(value).__name__
 
-class List(WrapedObject):
+
+class List(Object):
+
+  __slots__ = ('value',)
 
   def __init__(self, value):
     self.value = value
 
+  def XXBool(self):
+    return bool(self.value)
+
+  def XXEqual(self, other):
+    # Items are compared with their own Equal, since Python's == takes 1
+    # and true for equal.
+    return (type(other) is List and len(self.value) == len(other.value) and
+            all(map(Equal, self.value, other.value)))
+
   def XXPush(self, other):
     self.value.append(other)
+    return nil
 
   def XXString(self):
-    return String('[%s]' % ', '.join(map(str, self.value)))
+    return '[%s]' % ', '.join(map(ToString, self.value))
+
 
+class BuiltinFunction(Object):
+  """A Python function. What it returns is converted by ConvertValue."""
 
-class BuiltinFunction(WrapedObject):
+  __slots__ = ('function',)
+
+  def __init__(self, function):
+    self.function = function
 
   def __call__(self, *args):
-    return ConvertValue(self.value(*args))
+    return ConvertValue(self.function(*args))
+
+  def XXBool(self):
+    return True
 
 
 class UserFunction(Object):
+  """
+  Compiled function. Calls run body on a fresh frame laid out by FrameLayout:
+  the enclosing frame, the signal slot, the arguments and then the locals.
+  """
+
+  __slots__ = ('frame', 'arity', 'padding', 'body', 'origin')
+
+  def __init__(self, frame, arity, padding, body, origin=None):
+    self.frame = frame
+    self.arity = arity
+    self.padding = padding
+    self.body = body
+    self.origin = origin
+
+  def __call__(self, *args):
+    # A call in tail position returns a TailCall instead of making it, and
+    # it is made here in place of the caller's, so tail recursion runs in
+    # constant stack depth.
+    function = self
+    while True:
+      result = function.body(function.Frame(args))
+      if type(result) is not TailCall:
+        return result
+      function = result.function
+      args = result.args
+      if type(function) is not UserFunction:
+        return function(*args)
+
+  def Frame(self, args):
+    if len(args) != self.arity:
+      args = (tuple(args) + (UNDECLARED,) * self.arity)[:self.arity]
+    frame = [self.frame, None]
+    frame += args
+    frame += self.padding
+    return frame
+
+  def XXBool(self):
+    return True
+
+
+class TailCall(object):
+  """A call left for UserFunction.__call__ to make once its caller has returned."""
 
-  def __init__(self, scope, args, body):
+  __slots__ = ('function', 'args')
+
+  def __init__(self, function, args):
+    self.function = function
+    self.args = args
+
+
+class ReferenceFunction(Object):
+  """Function whose body is a Node run by the reference Evaluate."""
+
+  __slots__ = ('scope', 'args', 'body', 'origin')
+
+  def __init__(self, scope, args, body, origin=None):
     self.scope = scope
     self.args = args
     self.body = body
+    self.origin = origin
 
   def __call__(self, *args):
     scope = Scope(self.scope)
@@ -544,11 +1465,19 @@ class UserFunction(Object):
     return Evaluate(scope, self.body)
 
   def XXBool(self):
-    return true
+    return True
+
+
+class UserObject(Object):
+  """Object made by Create(). Unlike builtin values it takes any attribute."""
+
+  __slots__ = ('__dict__',)
 
 
 class Scope(object):
 
+  __slots__ = ('parent', 'table')
+
   def __init__(self, parent=None):
     self.parent = parent
     self.table = dict()
@@ -568,7 +1497,7 @@ class Scope(object):
       raise KeyError(key)
 
   def __setitem__(self, key, value):
-    assert isinstance(value, Object), type(value)
+    assert isinstance(value, Object) or type(value) in METHODS, type(value)
     if key in self.table:
       self.table[key] = value
     elif self.parent is not None:
@@ -576,21 +1505,24 @@ class Scope(object):
     else:
       raise KeyError(key)
 
+  def __contains__(self, key):
+    return key in self.table or (self.parent is not None and key in self.parent)
+
 ROOT_SCOPE = Scope()
 ROOT_SCOPE.Declare('nil', nil)
-ROOT_SCOPE.Declare('true', true)
-ROOT_SCOPE.Declare('false', false)
+ROOT_SCOPE.Declare('true', True)
+ROOT_SCOPE.Declare('false', False)
 
 
 @ROOT_SCOPE.DeclareBuiltin
 def Assert(cond, message=''):
   if not cond:
-    raise AssertError('Assertion error: ' + str(message))
+    raise AssertError('Assertion error: ' + ToString(message))
 
 
 @ROOT_SCOPE.DeclareBuiltin
 def Create():
-  return Object()
+  return UserObject()
 
 
 class CclError(Exception):
@@ -619,127 +1551,176 @@ class AssertError(CclError):
 
 
 def RevertValue(x):
-  if not isinstance(x, Object):
-    return x
-  elif isinstance(x, (Bool, Number, String)):
-    return x.value
-  elif isinstance(x, List):
+  if type(x) is List:
     return list(map(RevertValue, x.value))
-  else:
+  elif isinstance(x, Object):
     raise TypeError("Value is not convertible: %s" % type(x))
+  else:
+    return x
+
 
-
 def ConvertValue(value):
-  if isinstance(value, Object):
+  if isinstance(value, Object) or type(value) in METHODS:
     return value
   elif value is None:
     return nil
-  elif isinstance(value, bool):
-    return Bool(value)
-  elif isinstance(value, (int, float)):
-    return Number(value)
-  elif isinstance(value, str):
-    return String(value)
   elif isinstance(value, list):
-    return List(map(ConvertValue, value))
+    return List(ConvertList(value))
   else:
     raise TypeError("Value is not convertible: %s" % type(value))
 
 
+def ConvertList(values):
+  """
+  A new list of values converted. A list of only numbers, strings,
+  booleans and Objects, checked once per distinct type, is just copied.
+  """
+  for cls in set(map(type, values)):
+    if cls not in METHODS and not issubclass(cls, Object):
+      return [ConvertValue(value) for value in values]
+  return list(values)
+
+
+class InlineCache(object):
+  """
+  The methods that one call site's attribute name resolved to, by receiver
+  type, so that calls skip getattr and the bound method it makes.
+
+  Plain methods are remembered for up to LIMIT receiver types. Objects with
+  a __dict__, whose attributes may differ per instance, and new types seen
+  once the site has gone megamorphic are always looked up with getattr.
+  """
+
+  __slots__ = ('attr', 'origin', 'methods')
+
+  LIMIT = 4
+
+  def __init__(self, name, origin):
+    self.attr = 'XX' + name
+    self.origin = origin
+    self.methods = {}
+
+  def Method(self, owner):
+    """The bound method, remembering the plain function for type(owner)."""
+    try:
+      method = Attribute(owner, self.attr)
+    except AttributeError:
+      error = CclError('Object has no attribute ' + self.attr[2:])
+      error.trace.append(self.origin)
+      raise error
+    if len(self.methods) < self.LIMIT and not hasattr(owner, '__dict__'):
+      function = getattr(method, '__func__', None)
+      if type(function) is FunctionType:
+        self.methods[type(owner)] = function
+    return method
+
+
 def Evaluate(scope, node):
 
   if not isinstance(node.origin, Origin):
     raise TypeError((node.type, node.origin))
 
+  kind = node.kind
   try:
-    if node.type == 'Module':
+    if kind == MODULE_NODE or kind == BLOCK_NODE:
       last = nil
       for child in node.children:
         last = Evaluate(scope, child)
       return last
-    elif node.type == 'Name':
+    elif kind == NAME_NODE:
       try:
         return scope[node.value]
       except KeyError as e:
         raise CclError('%s is not defined' % str(e))
-    elif node.type == 'String':
-      return String(node.value)
-    elif node.type == 'Number':
-      return Number(node.value)
-    elif node.type == 'List':
+    elif kind == STRING_NODE or kind == NUMBER_NODE:
+      return node.value
+    elif kind == LIST_NODE:
       return List([Evaluate(scope, n) for n in node.children])
-    elif node.type == 'Function':
-      return UserFunction(scope, node.value, node.children[0])
-    elif node.type == 'Block':
-      last = nil
-      for child in node.children:
-        last = Evaluate(scope, child)
-      return last
-    elif node.type == 'break':
+    elif kind == FUNCTION_NODE:
+      return ReferenceFunction(scope, node.value, node.body, node.origin)
+    elif kind == BREAK_NODE:
       raise BreakException()
-    elif node.type == 'var':
+    elif kind == VAR_NODE:
       for name, arg in zip(node.value, node.children):
         scope.Declare(name)
         scope[name] = Evaluate(scope, arg)
       return nil
-    elif node.type == 'if':
-      if Evaluate(scope, node.children[0]):
-        return Evaluate(scope, node.children[1])
-      elif len(node.children) == 2:
+    elif kind == IF_NODE:
+      if Evaluate(scope, node.test):
+        return Evaluate(scope, node.body)
+      elif node.orelse is None:
         return nil
       else:
-        return Evaluate(scope, node.children[2])
-    elif node.type == 'while':
+        return Evaluate(scope, node.orelse)
+    elif kind == WHILE_NODE:
       last = nil
       try:
-        while Evaluate(scope, node.children[0]):
-          last = Evaluate(scope, node.children[1])
+        while Evaluate(scope, node.test):
+          last = Evaluate(scope, node.body)
       except BreakException:
         pass
       return last
-    elif node.type == 'return':
-      raise ReturnException(Evaluate(scope, node.children[0]))
-    elif node.type == 'Call':
-      f = Evaluate(scope, node.children[0])
-      args = Evaluate(scope, node.children[1])
+    elif kind == RETURN_NODE:
+      raise ReturnException(Evaluate(scope, node.operand))
+    elif kind == CALL_NODE:
+      f = Evaluate(scope, node.function)
+      args = Evaluate(scope, node.arguments)
       try:
-        result = f(*args)
+        return f(*args)
       except ReturnException as e:
-        result = e.value
+        return e.value
       except CclError as e:
         e.trace.append(node.origin)
         raise
-      return ConvertValue(result)
-    elif node.type == 'Arguments':
+    elif kind == METHOD_CALL_NODE:
+      arguments = node.arguments
+      owner = Evaluate(scope, node.receiver)
+      try:
+        method = Attribute(owner, 'XX' + node.value)
+      except AttributeError:
+        error = CclError('Object has no attribute ' + node.value)
+        error.trace.append(arguments.origin)
+        raise error
+      args = [Evaluate(scope, n) for n in arguments.children]
+      try:
+        return method(*args)
+      except ReturnException as e:
+        return e.value
+      except CclError as e:
+        e.trace.append(node.origin)
+        raise
+    elif kind == ARGUMENTS_NODE:
       return [Evaluate(scope, n) for n in node.children]
-    elif node.type == 'GetAttribute':
-      value, = node.children
-      owner = Evaluate(scope, value)
+    elif kind == GET_ATTRIBUTE_NODE:
+      owner = Evaluate(scope, node.owner)
       attr = 'XX' + node.value
       try:
-        return getattr(owner, attr)
+        return Attribute(owner, attr)
       except AttributeError:
         raise CclError('Object has no attribute ' + node.value)
-    elif node.type == 'SetAttribute':
-      lhs, rhs = [Evaluate(scope, n) for n in node.children]
-      return setattr(lhs, 'XX' + node.value, rhs)
-    elif node.type == 'and':
-      lhs, rhs = node.children
-      lhs = Evaluate(scope, lhs)
+    elif kind == SET_ATTRIBUTE_NODE:
+      lhs = Evaluate(scope, node.owner)
+      rhs = Evaluate(scope, node.rhs)
+      try:
+        setattr(lhs, 'XX' + node.value, rhs)
+      except AttributeError:
+        raise CclError('Cannot set attribute ' + node.value)
+      return nil
+    elif kind == AND_NODE:
+      lhs = Evaluate(scope, node.lhs)
       if lhs:
-        return Evaluate(scope, rhs)
+        return Evaluate(scope, node.rhs)
       else:
         return lhs
-    elif node.type == 'or':
-      lhs, rhs = node.children
-      lhs = Evaluate(scope, lhs)
+    elif kind == OR_NODE:
+      lhs = Evaluate(scope, node.lhs)
       if lhs:
         return lhs
       else:
-        return Evaluate(scope, rhs)
-    elif node.type == 'Assign':
+        return Evaluate(scope, node.rhs)
+    elif kind == ASSIGN_NODE:
       name = node.value
-      value = Evaluate(scope, node.children[0])
+      value = Evaluate(scope, node.rhs)
       try:
         scope[name] = value
       except KeyError as e:
@@ -747,26 +1728,2184 @@ def Evaluate(scope, node):
       return value
 
     raise CclError('Unrecognized node ' + node.type)
+  except BreakException:
+    if kind != MODULE_NODE:
+      raise
+    raise CclError('break outside of while')
   except CclError as e:
     if not e.trace:
       e.trace.append(node.origin)
     raise
 
 
-def Run(string, filename=None):
-  return Evaluate(ROOT_SCOPE, Parse(string, filename or '<unknown>'))
+OPTIMIZERS = dict()
+
+# Passes Optimize runs by default, in order: folding first so that the
+# tests it turns into constants can decide branches, and blocks after
+# branches so that Blocks left holding one branch are flattened too.
+PASSES = ('fold', 'branches', 'blocks', 'vars')
+
+
+def Optimizes(name):
+  """Register a pass. It is called on every node bottom up and returns its replacement."""
+  def Register(function):
+    OPTIMIZERS[name] = function
+    return function
+  return Register
+
+
+def Optimize(node, passes=PASSES):
+  """
+  Rewrite a parsed tree with the named passes, in the order given.
+
+  Passes rebuild the tree in place and keep what every mode computes and
+  prints. The one visible difference is that code in a removed branch is
+  no longer checked for undefined names. Returns the new root.
+  """
+  constants = Constants(node)
+  for name in passes:
+    node = Rewrite(node, OPTIMIZERS[name], constants)
+  return node
+
+
+def Rewrite(node, function, constants):
+  """Replace each node, children first, by function(node, constants)."""
+  stack = [(node, False)]
+  while stack:
+    parent, visited = stack.pop()
+    if visited:
+      if parent.children:
+        parent.children = [function(child, constants) for child in parent.children]
+    else:
+      stack.append((parent, True))
+      stack.extend((child, False) for child in parent.children)
+  return function(node, constants)
 
 
-def RunX(string, filename=None):
+def Constants(node):
+  """
+  The builtin names true, false and nil by value, unless the program
+  declares or assigns any of them and so may change what they mean.
+  """
+  constants = {'true': True, 'false': False, 'nil': nil}
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if node.kind == VAR_NODE or node.kind == FUNCTION_NODE:
+      for name in node.value:
+        constants.pop(name, None)
+    elif node.kind == ASSIGN_NODE:
+      constants.pop(node.value, None)
+    stack.extend(node.children)
+  return constants
+
+
+def ConstantValue(node, constants):
+  """The value of a literal or constant name node, or None."""
+  kind = node.kind
+  if kind == NUMBER_NODE or kind == STRING_NODE:
+    return node.value
+  elif kind == NAME_NODE:
+    return constants.get(node.value)
+
+
+def ConstantNode(value, origin, constants):
+  """A node that evaluates to value, or None if value has no literal form."""
+  if type(value) in NUMBER_TYPES:
+    return Node('Number', value, [], origin)
+  elif type(value) is str:
+    if len(value) <= FOLD_LIMIT:
+      return Node('String', value, [], origin)
+  else:
+    for name, constant in constants.items():
+      if value is constant:
+        return Node('Name', name, [], origin)
+
+
+# Methods without side effects, which are run on literal receivers and
+# arguments at optimize time.
+FOLDABLE_NUMBER_METHODS = frozenset((
+    'Add', 'Subtract', 'LessThan', 'LessThanOrEqualTo', 'GreaterThan',
+    'GreaterThanOrEqualTo', 'Equal', 'NotEqual', 'String'))
+FOLDABLE = {
+    int: FOLDABLE_NUMBER_METHODS,
+    float: FOLDABLE_NUMBER_METHODS,
+    str: frozenset((
+        'Size', 'Multiply', 'Slice', 'Get', 'Equal', 'NotEqual', 'String')),
+    bool: frozenset(('Equal', 'NotEqual', 'String')),
+    Nil: frozenset(('Equal', 'NotEqual', 'String')),
+}
+
+# Longest String a fold may write into the tree.
+FOLD_LIMIT = 1024
+
+# The length of the String a method would return, for the foldable methods
+# that can build a long one. They are checked against FOLD_LIMIT before the
+# method runs, so a fold never builds a String it will not keep.
+FOLD_SIZES = {
+    'Multiply': lambda owner, n: len(owner) * n,
+    'Slice': lambda owner, lower, upper: len(range(len(owner))[lower:upper]),
+}
+
+
+@Optimizes('fold')
+def FoldConstants(node, constants):
+  """Replace a pure method call on constants with its result."""
+  if node.kind != METHOD_CALL_NODE:
+    return node
+  owner = ConstantValue(node.receiver, constants)
+  if node.value not in FOLDABLE.get(type(owner), ()):
+    return node
+  args = [ConstantValue(child, constants) for child in node.arguments.children]
+  if None in args:
+    return node
+  size = FOLD_SIZES.get(node.value) if type(owner) is str else None
   try:
-    return Run(string, filename)
+    if size is not None and size(owner, *args) > FOLD_LIMIT:
+      return node
+    value = Attribute(owner, 'XX' + node.value)(*args)
+  except Exception:
+    # Left for the program to raise when it runs, with its trace.
+    return node
+  return ConstantNode(value, node.origin, constants) or node
+
+
+@Optimizes('branches')
+def RemoveDeadBranches(node, constants):
+  """
+  Replace an if on a constant test by the branch it takes, and a while
+  whose test is false by nil. Branches that declare names are kept, since
+  declarations are hoisted whether or not they run.
+  """
+  if node.kind != IF_NODE and node.kind != WHILE_NODE:
+    return node
+  test = ConstantValue(node.test, constants)
+  if test is None or any(map(Declarations, node.children[1:])):
+    return node
+  if node.kind == IF_NODE:
+    if test:
+      return node.body
+    elif node.orelse is not None:
+      return node.orelse
+  elif test:
+    return node
+  return ConstantNode(nil, node.origin, constants) or node
+
+
+@Optimizes('blocks')
+def FlattenBlocks(node, constants):
+  """A Block of one expression is just that expression."""
+  if node.kind == BLOCK_NODE and len(node.children) == 1:
+    return node.children[0]
+  return node
+
+
+@Optimizes('vars')
+def RemoveUnusedVars(node, constants):
+  """
+  Drop locals of a function that are never read or assigned anywhere in
+  its body, including nested functions, when their initial value is a
+  literal, constant or function and so has no side effects.
+  """
+  if node.kind != FUNCTION_NODE:
+    return node
+  used = set()
+  stack = [node.body]
+  while stack:
+    child = stack.pop()
+    if child.kind == NAME_NODE or child.kind == ASSIGN_NODE:
+      used.add(child.value)
+    stack.extend(child.children)
+  stack = [node.body]
+  while stack:
+    child = stack.pop()
+    if child.kind == VAR_NODE:
+      pairs = [
+          (name, value) for name, value in zip(child.value, child.children)
+          if name in used or not (
+              value.kind == FUNCTION_NODE or
+              ConstantValue(value, constants) is not None)]
+      child.value = [name for name, _ in pairs]
+      child.children = [value for _, value in pairs]
+    if child.kind != FUNCTION_NODE:
+      stack.extend(child.children)
+  return node
+
+
+def Declarations(node):
+  """Names declared with var in node, not counting nested Functions."""
+  names = []
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if node.kind == VAR_NODE:
+      names.extend(node.value)
+    if node.kind != FUNCTION_NODE:
+      stack.extend(reversed(node.children))
+  return names
+
+
+# Signals left in frame[1] by a return or break in statement position.
+RETURN = 1
+BREAK = 2
+
+
+def Completions(body, module=False):
+  """
+  Find the statements of a function or module body that can complete with
+  a signal instead of falling through.
+
+  Statement position is the body itself, the children of a Block and the
+  branches of an if or the body of a while in statement position. A return
+  or break there sets frame[1] and its enclosing Blocks and whiles check it,
+  instead of raising ReturnException or BreakException. A return whose
+  value is the body's value anyway (a tail return) needs no signal at all.
+
+  A Call or MethodCall whose value is returned as it is, being in tail
+  position or the value of a return in statement position, is a tail call.
+
+  A return in a module body is neither: as in Evaluate, it raises
+  ReturnException out of the program.
+
+  Returns (completions, tails): a dict from node id to the signals the node
+  may leave, and the set of tail return and tail call node ids.
+  """
+  completions = dict()
+  tails = set()
+
+  # Statement positions in preorder, with the signal each leaves itself and
+  # the index of its parent, so signals are gathered children first from
+  # the end without recursing.
+  order = []
+  stack = [(body, False, True, -1)]
+  while stack:
+    node, loop, tail, parent = stack.pop()
+    index = len(order)
+    signals = 0
+    kind = node.kind
+    if kind == RETURN_NODE and module:
+      pass
+    elif kind == RETURN_NODE:
+      if tail:
+        tails.add(id(node))
+      else:
+        signals = RETURN
+      if node.operand.kind == CALL_NODE or node.operand.kind == METHOD_CALL_NODE:
+        tails.add(id(node.operand))
+    elif kind == CALL_NODE or kind == METHOD_CALL_NODE:
+      if tail:
+        tails.add(id(node))
+    elif kind == BREAK_NODE:
+      signals = BREAK if loop else 0
+    elif kind == MODULE_NODE or kind == BLOCK_NODE:
+      last = len(node.children) - 1
+      for i, child in enumerate(node.children):
+        stack.append((child, loop, tail and i == last, index))
+    elif kind == IF_NODE:
+      stack.append((node.body, loop, tail, index))
+      if node.orelse is not None:
+        stack.append((node.orelse, loop, tail, index))
+    elif kind == WHILE_NODE:
+      stack.append((node.body, True, False, index))
+    order.append([node, parent, signals])
+
+  for node, parent, signals in reversed(order):
+    if node.kind == WHILE_NODE:
+      signals &= RETURN
+    if signals:
+      completions[id(node)] = signals
+      if parent >= 0:
+        order[parent][2] |= signals
+
+  return completions, tails
+
+
+class FrameLayout(object):
+  """
+  Compile time view of where each name lives.
+
+  A function frame is a list holding the enclosing frame, the pending
+  return or break signal, the arguments and then every name declared with
+  var anywhere in the body, so each local resolves to a fixed (depth,
+  index) slot. The module level layout (parent None) has a frame with no
+  locals; its names live in the global Scope.
+
+  As in Evaluate, a local is only declared once its var has run. Until
+  then its slot, like that of a missing argument, holds UNDECLARED, and
+  the name is looked up in the enclosing functions and then the global
+  Scope instead.
+  """
+
+  __slots__ = ('parent', 'scope', 'coverage', 'slots', 'completions', 'tails')
+
+  def __init__(self, parent, args, body, scope, coverage=None):
+    self.parent = parent
+    self.scope = scope
+    self.coverage = coverage if parent is None else parent.coverage
+    self.slots = dict()
+    for name in list(args) + Declarations(body):
+      if name not in self.slots:
+        self.slots[name] = len(self.slots) + 2
+    self.completions, self.tails = Completions(body, parent is None)
+
+  def Resolve(self, name):
+    """Returns (depth, index) of the innermost local or None for a global."""
+    slots = self.Slots(name)
+    return slots[0] if slots else None
+
+  def Slots(self, name):
+    """
+    The (depth, index) of each local called name in this and enclosing
+    layouts, innermost first: where it is looked up while undeclared.
+    """
+    slots = []
+    layout = self
+    depth = 0
+    while layout.parent is not None:
+      if name in layout.slots:
+        slots.append((depth, layout.slots[name]))
+      layout = layout.parent
+      depth += 1
+    if slots or name in layout.slots or name in layout.scope:
+      return slots
+    raise CclError('%r is not defined' % name)
+
+
+# What the slot of a local holds until its var runs.
+UNDECLARED = object()
+
+
+def LoadOuter(frame, name, slots, scope):
+  """
+  The value of name from the first of slots, relative to frame, that is
+  declared, or from scope. Raises KeyError if it is declared nowhere.
+  """
+  for depth, index in slots:
+    outer = frame
+    for _ in range(depth):
+      outer = outer[0]
+    value = outer[index]
+    if value is not UNDECLARED:
+      return value
+  return scope[name]
+
+
+def StoreOuter(frame, name, slots, scope, value):
+  """Assign value to name where LoadOuter would find it."""
+  for depth, index in slots:
+    outer = frame
+    for _ in range(depth):
+      outer = outer[0]
+    if outer[index] is not UNDECLARED:
+      outer[index] = value
+      return
+  scope[name] = value
+
+
+# Compilers indexed by node kind.
+COMPILERS = [None] * len(NODE_TYPES)
+
+
+def Compiles(type_):
+  def wrapper(f):
+    COMPILERS[KINDS[type_]] = f
+    return f
+  return wrapper
+
+
+def Compile(node, layout):
+  """
+  Turn a Node into a Python closure taking a frame.
+
+  Dispatch on node.kind and name resolution happen once here instead of
+  on every visit as in Evaluate, which is kept around as the reference
+  implementation.
+  """
+
+  if not isinstance(node.origin, Origin):
+    raise TypeError((node.type, node.origin))
+
+  try:
+    compiler = None if node.kind is None else COMPILERS[node.kind]
+    if compiler is None:
+      raise CclError('Unrecognized node ' + node.type)
+    if layout.coverage is not None:
+      return layout.coverage.Instrument(node, compiler(node, layout))
+    return compiler(node, layout)
+  except CclError as e:
+    if not e.trace:
+      e.trace.append(node.origin)
+    raise
+
+
+def NotDefined(name, origin):
+  error = CclError('%r is not defined' % name)
+  error.trace.append(origin)
+  return error
+
+
+@Compiles('Module')
+@Compiles('Block')
+def CompileBlock(node, layout):
+  children = [Compile(child, layout) for child in node.children]
+
+  if not children:
+    return lambda frame: nil
+  elif len(children) == 1:
+    return children[0]
+
+  init = tuple(children[:-1])
+  last = children[-1]
+
+  if not any(id(child) in layout.completions for child in node.children[:-1]):
+    def Block(frame):
+      for child in init:
+        child(frame)
+      return last(frame)
+  else:
+    def Block(frame):
+      for child in init:
+        value = child(frame)
+        if frame[1]:
+          return value
+      return last(frame)
+
+  return Block
+
+
+@Compiles('Name')
+def CompileName(node, layout):
+  name = node.value
+  slot = layout.Resolve(name)
+
+  if slot is None:
+    scope = layout.scope
+    table = scope.table
+    origin = node.origin
+
+    def Name(frame):
+      try:
+        return table[name]
+      except KeyError:
+        pass
+      try:
+        return scope[name]
+      except KeyError:
+        raise NotDefined(name, origin)
+
+    return Name
+
+  depth, index = slot
+  outer = layout.Slots(name)[1:]
+  scope = layout.scope
+  origin = node.origin
+
+  def Outer(frame):
+    try:
+      return LoadOuter(frame, name, outer, scope)
+    except KeyError:
+      raise NotDefined(name, origin)
+
+  if depth == 0:
+    def Name(frame):
+      value = frame[index]
+      if value is UNDECLARED:
+        return Outer(frame)
+      return value
+  elif depth == 1:
+    def Name(frame):
+      value = frame[0][index]
+      if value is UNDECLARED:
+        return Outer(frame)
+      return value
+  else:
+    def Name(frame):
+      local = frame
+      for _ in range(depth):
+        local = local[0]
+      value = local[index]
+      if value is UNDECLARED:
+        return Outer(frame)
+      return value
+
+  return Name
+
+
+@Compiles('String')
+@Compiles('Number')
+def CompileLiteral(node, layout):
+  value = node.value
+  return lambda frame: value
+
+
+@Compiles('List')
+def CompileList(node, layout):
+  children = [Compile(child, layout) for child in node.children]
+  return lambda frame: List([child(frame) for child in children])
+
+
+@Compiles('Function')
+def CompileFunction(node, layout):
+  args = node.value
+  inner = FrameLayout(layout, args, node.body, layout.scope)
+  body = Compile(node.body, inner)
+  arity = len(args)
+  padding = [UNDECLARED] * (len(inner.slots) - arity)
+  origin = node.origin
+  return lambda frame: UserFunction(frame, arity, padding, body, origin)
+
+
+@Compiles('break')
+def CompileBreak(node, layout):
+  if id(node) in layout.completions:
+    def Break(frame):
+      frame[1] = BREAK
+      return nil
+  else:
+    def Break(frame):
+      raise BreakException()
+  return Break
+
+
+def CompileStore(name, value, layout, origin):
+  """Closure that evaluates value, stores it in name and returns it."""
+  slot = layout.Resolve(name)
+
+  if slot is None:
+    scope = layout.scope
+
+    def Store(frame):
+      result = value(frame)
+      try:
+        scope[name] = result
+      except KeyError:
+        raise NotDefined(name, origin)
+      return result
+
+    return Store
+
+  depth, index = slot
+  outer = layout.Slots(name)[1:]
+  scope = layout.scope
+
+  def Outer(frame, result):
+    try:
+      StoreOuter(frame, name, outer, scope, result)
+    except KeyError:
+      raise NotDefined(name, origin)
+    return result
+
+  if depth == 0:
+    def Store(frame):
+      result = value(frame)
+      if frame[index] is UNDECLARED:
+        return Outer(frame, result)
+      frame[index] = result
+      return result
+  else:
+    def Store(frame):
+      result = value(frame)
+      local = frame
+      for _ in range(depth):
+        local = local[0]
+      if local[index] is UNDECLARED:
+        return Outer(frame, result)
+      local[index] = result
+      return result
+
+  return Store
+
+
+def CompileDeclare(name, node, layout):
+  """Closure that declares the local name with the value of node."""
+  index = layout.slots[name]
+  value = Compile(node, layout)
+
+  # Evaluate declares the name before evaluating its value, so the value
+  # sees nil there, even through a closure it calls.
+  def Declare(frame):
+    frame[index] = nil
+    frame[index] = value(frame)
+
+  return Declare
+
+
+@Compiles('var')
+def CompileVar(node, layout):
+  if layout.parent is None:
+    scope = layout.scope
+    pairs = tuple(zip(node.value, [Compile(child, layout) for child in node.children]))
+
+    def Var(frame):
+      for name, value in pairs:
+        scope.Declare(name)
+        scope[name] = value(frame)
+      return nil
+
+    return Var
+
+  declares = tuple(
+      CompileDeclare(name, child, layout)
+      for name, child in zip(node.value, node.children))
+
+  def Var(frame):
+    for declare in declares:
+      declare(frame)
+    return nil
+
+  return Var
+
+
+@Compiles('if')
+def CompileIf(node, layout):
+  test = Compile(node.test, layout)
+  body = Compile(node.body, layout)
+  orelse = None if node.orelse is None else Compile(node.orelse, layout)
+
+  if orelse is None:
+    def If(frame):
+      if test(frame):
+        return body(frame)
+      return nil
+  else:
+    def If(frame):
+      if test(frame):
+        return body(frame)
+      return orelse(frame)
+
+  return If
+
+
+@Compiles('while')
+def CompileWhile(node, layout):
+  test = Compile(node.test, layout)
+  body = Compile(node.body, layout)
+
+  if id(node.body) not in layout.completions:
+    def While(frame):
+      last = nil
+      try:
+        while test(frame):
+          last = body(frame)
+      except BreakException:
+        pass
+      return last
+  else:
+    def While(frame):
+      last = nil
+      try:
+        while test(frame):
+          value = body(frame)
+          if frame[1]:
+            if frame[1] == BREAK:
+              frame[1] = None
+              return last
+            return value
+          last = value
+      except BreakException:
+        pass
+      return last
+
+  return While
+
+
+@Compiles('return')
+def CompileReturn(node, layout):
+  value = Compile(node.operand, layout)
+
+  if id(node) in layout.tails:
+    return value
+  elif id(node) in layout.completions:
+    def Return(frame):
+      result = value(frame)
+      frame[1] = RETURN
+      return result
+  else:
+    def Return(frame):
+      raise ReturnException(value(frame))
+
+  return Return
+
+
+@Compiles('Call')
+def CompileCall(node, layout):
+  f = Compile(node.function, layout)
+  args = tuple(Compile(child, layout) for child in node.arguments.children)
+  origin = node.origin
+
+  if layout.parent is not None and id(node) in layout.tails:
+    def TailCallSite(frame):
+      return TailCall(f(frame), [arg(frame) for arg in args])
+
+    return TailCallSite
+
+  # The callee and arguments are evaluated outside the try, so that a
+  # return in an argument returns from the enclosing function instead of
+  # being taken for what this call returned.
+  def Call(frame):
+    function = f(frame)
+    values = [arg(frame) for arg in args]
+    try:
+      return function(*values)
+    except ReturnException as e:
+      return e.value
+    except CclError as e:
+      e.trace.append(origin)
+      raise
+
+  return Call
+
+
+@Compiles('MethodCall')
+def CompileMethodCall(node, layout):
+  """Call of a method, through an InlineCache for the call site."""
+  receiver = Compile(node.receiver, layout)
+  arguments = node.arguments
+  args = tuple(Compile(child, layout) for child in arguments.children)
+  cache = InlineCache(node.value, arguments.origin)
+  methods = cache.methods
+  origin = node.origin
+
+  # As in Call, only the call itself is in the try. Methods found in the
+  # cache are called unbound, and most take no arguments or one, so those
+  # skip building a list.
+  if not args:
+    def MethodCall(frame):
+      owner = receiver(frame)
+      function = methods.get(type(owner))
+      method = None if function is not None else cache.Method(owner)
+      try:
+        if method is None:
+          return function(owner)
+        return method()
+      except ReturnException as e:
+        return e.value
+      except CclError as e:
+        e.trace.append(origin)
+        raise
+  elif len(args) == 1:
+    arg, = args
+    def MethodCall(frame):
+      owner = receiver(frame)
+      function = methods.get(type(owner))
+      method = None if function is not None else cache.Method(owner)
+      value = arg(frame)
+      try:
+        if method is None:
+          return function(owner, value)
+        return method(value)
+      except ReturnException as e:
+        return e.value
+      except CclError as e:
+        e.trace.append(origin)
+        raise
+  else:
+    def MethodCall(frame):
+      owner = receiver(frame)
+      function = methods.get(type(owner))
+      method = None if function is not None else cache.Method(owner)
+      values = [arg(frame) for arg in args]
+      try:
+        if method is None:
+          return function(owner, *values)
+        return method(*values)
+      except ReturnException as e:
+        return e.value
+      except CclError as e:
+        e.trace.append(origin)
+        raise
+
+  # A method that is a UserFunction is left to UserFunction.__call__ in
+  # tail position, as in Call. Other methods are called here, since they
+  # do not recurse through ccl frames.
+  if layout.parent is not None and id(node) in layout.tails:
+    def TailMethodCall(frame):
+      owner = receiver(frame)
+      function = methods.get(type(owner))
+      method = None if function is not None else cache.Method(owner)
+      values = [arg(frame) for arg in args]
+      if type(method) is UserFunction:
+        return TailCall(method, values)
+      try:
+        if method is None:
+          return function(owner, *values)
+        return method(*values)
+      except ReturnException as e:
+        return e.value
+      except CclError as e:
+        e.trace.append(origin)
+        raise
+
+    return TailMethodCall
+
+  return MethodCall
+
+
+@Compiles('Arguments')
+def CompileArguments(node, layout):
+  children = [Compile(child, layout) for child in node.children]
+  return lambda frame: [child(frame) for child in children]
+
+
+@Compiles('GetAttribute')
+def CompileGetAttribute(node, layout):
+  owner = Compile(node.owner, layout)
+  attr = 'XX' + node.value
+  name = node.value
+  origin = node.origin
+
+  def GetAttribute(frame):
+    try:
+      return Attribute(owner(frame), attr)
+    except AttributeError:
+      error = CclError('Object has no attribute ' + name)
+      error.trace.append(origin)
+      raise error
+
+  return GetAttribute
+
+
+@Compiles('SetAttribute')
+def CompileSetAttribute(node, layout):
+  lhs = Compile(node.owner, layout)
+  rhs = Compile(node.rhs, layout)
+  attr = 'XX' + node.value
+  name = node.value
+  origin = node.origin
+
+  def SetAttribute(frame):
+    owner = lhs(frame)
+    value = rhs(frame)
+    try:
+      setattr(owner, attr, value)
+    except AttributeError:
+      error = CclError('Cannot set attribute ' + name)
+      error.trace.append(origin)
+      raise error
+    return nil
+
+  return SetAttribute
+
+
+@Compiles('and')
+def CompileAnd(node, layout):
+  lhs = Compile(node.lhs, layout)
+  rhs = Compile(node.rhs, layout)
+
+  def And(frame):
+    value = lhs(frame)
+    if value:
+      return rhs(frame)
+    return value
+
+  return And
+
+
+@Compiles('or')
+def CompileOr(node, layout):
+  lhs = Compile(node.lhs, layout)
+  rhs = Compile(node.rhs, layout)
+
+  def Or(frame):
+    value = lhs(frame)
+    if value:
+      return value
+    return rhs(frame)
+
+  return Or
+
+
+@Compiles('Assign')
+def CompileAssign(node, layout):
+  return CompileStore(node.value, Compile(node.rhs, layout), layout, node.origin)
+
+
+def RunModule(body, frame):
+  """Call the compiled body of a module, as a break outside a while raises."""
+  try:
+    return body(frame)
+  except BreakException:
+    raise CclError('break outside of while')
+
+
+def Execute(scope, node, coverage=None):
+  layout = FrameLayout(None, (), node, scope, coverage)
+  return RunModule(Compile(node, layout), [None, None])
+
+
+OPCODES = (
+    'LoadConst',
+    'LoadLocal',
+    'LoadDeref',
+    'LoadGlobal',
+    'StoreLocal',
+    'StoreDeref',
+    'StoreGlobal',
+    'DeclareGlobal',
+    'DeclareLocal',
+    'GetAttr',
+    'SetAttr',
+    'Call',
+    'CallMethod',
+    'TailCall',
+    'TailCallMethod',
+    'BuildList',
+    'MakeFunction',
+    'Pop',
+    'PopUnder',
+    'Truncate',
+    'Break',
+    'Jump',
+    'JumpIfFalse',
+    'JumpIfFalseOrPop',
+    'JumpIfTrueOrPop',
+    'Return',
+)
+
+(
+    LOAD_CONST,
+    LOAD_LOCAL,
+    LOAD_DEREF,
+    LOAD_GLOBAL,
+    STORE_LOCAL,
+    STORE_DEREF,
+    STORE_GLOBAL,
+    DECLARE_GLOBAL,
+    DECLARE_LOCAL,
+    GET_ATTR,
+    SET_ATTR,
+    CALL,
+    CALL_METHOD,
+    TAIL_CALL,
+    TAIL_CALL_METHOD,
+    BUILD_LIST,
+    MAKE_FUNCTION,
+    POP,
+    POP_UNDER,
+    TRUNCATE,
+    BREAK_OP,
+    JUMP,
+    JUMP_IF_FALSE,
+    JUMP_IF_FALSE_OR_POP,
+    JUMP_IF_TRUE_OR_POP,
+    RETURN_OP,
+) = range(len(OPCODES))
+
+
+class Code(object):
+  """
+  Bytecode for a module or function body.
+
+  ops is a flat sequence of (opcode, argument) pairs. Arguments index into
+  constants, names (globals and 'XX' attribute names), slots ((depth,
+  index) pairs for LoadDeref/StoreDeref) or sites ((InlineCache, count)
+  pairs for CallMethod and TailCallMethod), or are jump targets, stack depths and counts.
+  outers maps the (depth, index) of each local that is loaded or stored
+  to its name and the slots to look in while it is UNDECLARED. loops holds
+  the (top, end, depth) of each while, inner ones first: a break raised
+  while pc is in (top, end] leaves the stack at depth and goes to end.
+  origins holds the Origin of each instruction, and origin that of the
+  Function node for a function body or None for a module.
+  """
+
+  __slots__ = (
+      'name', 'ops', 'constants', 'names', 'slots', 'outers', 'sites', 'origins',
+      'loops', 'scope', 'arity', 'padding', 'origin')
+
+  def __init__(
+      self, name, ops, constants, names, slots, outers, sites, origins, loops, scope,
+      arity, padding, origin=None):
+    self.name = name
+    self.ops = ops
+    self.constants = constants
+    self.names = names
+    self.slots = slots
+    self.outers = outers
+    self.sites = sites
+    self.origins = origins
+    self.loops = loops
+    self.scope = scope
+    self.arity = arity
+    self.padding = padding
+    self.origin = origin
+
+  def __call__(self, frame):
+    return RunCode(self, frame)
+
+
+def Assemble(node, layout, name='<module>', arity=0, origin=None):
+  """
+  Compile a Node into a Code object run against frames laid out by layout.
+  origin is that of the Function node whose body node is, if any.
+
+  The Code of each nested Function is assembled from a work list once the
+  Code that makes it is done, and then put in its constant slot, so that
+  how deeply functions nest is not limited by Python's recursion limit.
+  """
+  pending = []
+  code = AssembleBody(node, layout, name, arity, origin, pending)
+  while pending:
+    constants, index, body, outer, args, origin = pending.pop()
+    inner = FrameLayout(outer, args, body, outer.scope)
+    constants[index] = AssembleBody(
+        body, inner, '<function line %d>' % origin.LineNumber(), len(args), origin, pending)
+  return code
+
+
+def AssembleBody(node, layout, name, arity, origin, pending):
+  """
+  The Code for one body, as Assemble. Each Function in it gets a constant
+  slot, holding None until its Code is assembled from pending.
+  """
+
+  ops = []
+  constants = []
+  names = []
+  slots = []
+  outers = dict()
+  sites = []
+  origins = []
+  loops = []
+  ranges = []
+  depth = [0]
+
+  def Emit(op, arg, effect, origin):
+    ops.append(op)
+    ops.append(arg)
+    origins.append(origin)
+    depth[0] += effect
+    return len(ops) - 1
+
+  def Patch(position):
+    ops[position] = len(ops)
+
+  def Index(table, value):
+    if value not in table:
+      table.append(value)
+    return table.index(value)
+
+  def Constant(value):
+    for i, constant in enumerate(constants):
+      if constant is value:
+        return i
+    constants.append(value)
+    return len(constants) - 1
+
+  def Local(name):
+    """The innermost slot of name, noting where else to look for it."""
+    found = layout.Slots(name)
+    if found:
+      outers[found[0]] = (name, tuple(found[1:]))
+      return found[0]
+
+  def Store(name, origin):
+    slot = Local(name)
+    if slot is None:
+      Emit(STORE_GLOBAL, Index(names, name), 0, origin)
+    elif slot[0] == 0:
+      Emit(STORE_LOCAL, slot[1], 0, origin)
+    else:
+      Emit(STORE_DEREF, Index(slots, slot), 0, origin)
+
+  def Visit(node):
+    # Nodes are visited from an explicit stack of VisitNode generators, each
+    # yielding the children it needs assembled in turn, so that nesting is
+    # not limited by Python's recursion limit.
+    stack = [(node, VisitNode(node))]
+    while stack:
+      node, visit = stack[-1]
+      try:
+        child = next(visit, None)
+      except CclError as e:
+        if not e.trace:
+          e.trace.append(node.origin)
+        raise
+      if child is None:
+        stack.pop()
+      else:
+        stack.append((child, VisitNode(child)))
+
+  def VisitNode(node):
+    """Emit node's code, yielding each child where its code belongs."""
+    origin = node.origin
+    kind = node.kind
+    if kind == MODULE_NODE or kind == BLOCK_NODE:
+      if not node.children:
+        Emit(LOAD_CONST, Constant(nil), 1, origin)
+      for i, child in enumerate(node.children):
+        if i:
+          Emit(POP, 0, -1, origin)
+        yield child
+    elif kind == NAME_NODE:
+      slot = Local(node.value)
+      if slot is None:
+        Emit(LOAD_GLOBAL, Index(names, node.value), 1, origin)
+      elif slot[0] == 0:
+        Emit(LOAD_LOCAL, slot[1], 1, origin)
+      else:
+        Emit(LOAD_DEREF, Index(slots, slot), 1, origin)
+    elif kind == STRING_NODE or kind == NUMBER_NODE:
+      Emit(LOAD_CONST, Constant(node.value), 1, origin)
+    elif kind == LIST_NODE:
+      for child in node.children:
+        yield child
+      Emit(BUILD_LIST, len(node.children), 1 - len(node.children), origin)
+    elif kind == FUNCTION_NODE:
+      constants.append(None)
+      pending.append((constants, len(constants) - 1, node.body, layout, node.value, origin))
+      Emit(MAKE_FUNCTION, len(constants) - 1, 1, origin)
+    elif kind == BREAK_NODE:
+      if not loops:
+        # Left to end whichever while is running when it is reached.
+        Emit(BREAK_OP, 0, 1, origin)
+        return
+      base, breaks = loops[-1]
+      Emit(TRUNCATE, base, base - depth[0], origin)
+      breaks.append(Emit(JUMP, None, 0, origin))
+      depth[0] += 1
+    elif kind == VAR_NODE:
+      for name, child in zip(node.value, node.children):
+        if layout.parent is None:
+          Emit(DECLARE_GLOBAL, Index(names, name), 0, origin)
+          yield child
+          Store(name, origin)
+        else:
+          # Evaluate declares the name before evaluating its value.
+          Emit(LOAD_CONST, Constant(nil), 1, origin)
+          Emit(DECLARE_LOCAL, layout.slots[name], 0, origin)
+          Emit(POP, 0, -1, origin)
+          yield child
+          Emit(DECLARE_LOCAL, layout.slots[name], 0, origin)
+        Emit(POP, 0, -1, origin)
+      Emit(LOAD_CONST, Constant(nil), 1, origin)
+    elif kind == IF_NODE:
+      yield node.test
+      orelse = Emit(JUMP_IF_FALSE, None, -1, origin)
+      yield node.body
+      end = Emit(JUMP, None, -1, origin)
+      Patch(orelse)
+      if node.orelse is not None:
+        yield node.orelse
+      else:
+        Emit(LOAD_CONST, Constant(nil), 1, origin)
+      Patch(end)
+    elif kind == WHILE_NODE:
+      Emit(LOAD_CONST, Constant(nil), 1, origin)
+      top = len(ops)
+      loops.append((depth[0], []))
+      yield node.test
+      end = Emit(JUMP_IF_FALSE, None, -1, origin)
+      yield node.body
+      Emit(POP_UNDER, 0, -1, origin)
+      Emit(JUMP, top, 0, origin)
+      Patch(end)
+      base, breaks = loops.pop()
+      for position in breaks:
+        Patch(position)
+      ranges.append((top, len(ops), base))
+    elif kind == RETURN_NODE:
+      yield node.operand
+      # A return in the module body raises, as in Evaluate.
+      Emit(RETURN_OP, int(layout.parent is None), 0, origin)
+    elif kind == METHOD_CALL_NODE:
+      args = node.arguments
+      yield node.receiver
+      for arg in args.children:
+        yield arg
+      sites.append((InlineCache(node.value, args.origin), len(args.children)))
+      if layout.parent is not None and id(node) in layout.tails:
+        Emit(TAIL_CALL_METHOD, len(sites) - 1, -len(args.children), origin)
+      else:
+        Emit(CALL_METHOD, len(sites) - 1, -len(args.children), origin)
+    elif kind == CALL_NODE:
+      args = node.arguments
+      yield node.function
+      for arg in args.children:
+        yield arg
+      if layout.parent is not None and id(node) in layout.tails:
+        Emit(TAIL_CALL, len(args.children), -len(args.children), origin)
+      else:
+        Emit(CALL, len(args.children), -len(args.children), origin)
+    elif kind == GET_ATTRIBUTE_NODE:
+      yield node.owner
+      Emit(GET_ATTR, Index(names, 'XX' + node.value), 0, origin)
+    elif kind == SET_ATTRIBUTE_NODE:
+      yield node.owner
+      yield node.rhs
+      Emit(SET_ATTR, Index(names, 'XX' + node.value), -1, origin)
+    elif kind == AND_NODE:
+      yield node.lhs
+      end = Emit(JUMP_IF_FALSE_OR_POP, None, -1, origin)
+      yield node.rhs
+      Patch(end)
+    elif kind == OR_NODE:
+      yield node.lhs
+      end = Emit(JUMP_IF_TRUE_OR_POP, None, -1, origin)
+      yield node.rhs
+      Patch(end)
+    elif kind == ASSIGN_NODE:
+      yield node.rhs
+      Store(node.value, origin)
+    else:
+      raise CclError('Unrecognized node ' + node.type)
+
+  Visit(node)
+  Emit(RETURN_OP, 0, -1, node.origin)
+
+  padding = [UNDECLARED] * (len(layout.slots) - arity) if layout.parent is not None else []
+  return Code(
+      name, tuple(ops), constants, names, slots, outers, sites, origins, tuple(ranges),
+      layout.scope, arity, padding, origin)
+
+
+def LoadOuterCode(code, frame, slot):
+  """LoadOuter for the local at slot of code, which is UNDECLARED."""
+  name, outer = code.outers[slot]
+  try:
+    return LoadOuter(frame, name, outer, code.scope)
+  except KeyError:
+    raise CclError('%r is not defined' % name)
+
+
+def StoreOuterCode(code, frame, slot, value):
+  """StoreOuter for the local at slot of code, which is UNDECLARED."""
+  name, outer = code.outers[slot]
+  try:
+    StoreOuter(frame, name, outer, code.scope, value)
+  except KeyError:
+    raise CclError('%r is not defined' % name)
+
+
+def BreakTarget(code, pc):
+  """The (top, end, depth) of the innermost while of code that pc is in, or None."""
+  for loop in code.loops:
+    if loop[0] < pc <= loop[1]:
+      return loop
+
+
+def RunCode(code, frame):
+  """
+  Run code against frame.
+
+  A call to a UserFunction whose body is Code runs in this same loop: the
+  caller's code, frame, stack and pc are saved on calls and restored when
+  the callee returns, so ccl calls do not grow the Python stack either.
+  """
+  calls = []
+  stack = []
+  pc = 0
+
+  while True:
+    ops = code.ops
+    constants = code.constants
+    names = code.names
+    scope = code.scope
+    table = scope.table
+    push = stack.append
+    pop = stack.pop
+
+    try:
+      while True:
+        op = ops[pc]
+        arg = ops[pc + 1]
+        pc += 2
+
+        if op == LOAD_LOCAL:
+          value = frame[arg]
+          if value is UNDECLARED:
+            value = LoadOuterCode(code, frame, (0, arg))
+          push(value)
+        elif op == LOAD_GLOBAL:
+          try:
+            push(table[names[arg]])
+          except KeyError:
+            if names[arg] not in scope:
+              raise CclError('%r is not defined' % names[arg])
+            push(scope[names[arg]])
+        elif op == LOAD_CONST:
+          push(constants[arg])
+        elif op == GET_ATTR:
+          try:
+            stack[-1] = Attribute(stack[-1], names[arg])
+          except AttributeError:
+            raise CclError('Object has no attribute ' + names[arg][2:])
+        elif op == CALL:
+          if arg:
+            args = stack[-arg:]
+            del stack[-arg:]
+          else:
+            args = ()
+          function = stack[-1]
+          if type(function) is UserFunction and type(function.body) is Code:
+            calls.append((code, frame, stack, pc))
+            code = function.body
+            frame = function.Frame(args)
+            stack = []
+            pc = 0
+            break
+          try:
+            stack[-1] = function(*args)
+          except CclError as e:
+            e.trace.append(code.origins[pc // 2 - 1])
+            raise
+        elif op == CALL_METHOD:
+          cache, count = code.sites[arg]
+          start = len(stack) - count
+          args = stack[start:]
+          del stack[start:]
+          owner = stack[-1]
+          function = cache.methods.get(type(owner))
+          if function is None:
+            method = cache.Method(owner)
+            if type(method) is UserFunction and type(method.body) is Code:
+              calls.append((code, frame, stack, pc))
+              code = method.body
+              frame = method.Frame(args)
+              stack = []
+              pc = 0
+              break
+          try:
+            if function is None:
+              stack[-1] = method(*args)
+            else:
+              stack[-1] = function(owner, *args)
+          except CclError as e:
+            e.trace.append(code.origins[pc // 2 - 1])
+            raise
+        elif op == TAIL_CALL:
+          start = len(stack) - arg
+          args = stack[start:]
+          del stack[start:]
+          stack[-1] = TailCall(stack[-1], args)
+        elif op == TAIL_CALL_METHOD:
+          cache, count = code.sites[arg]
+          start = len(stack) - count
+          args = stack[start:]
+          del stack[start:]
+          owner = stack[-1]
+          function = cache.methods.get(type(owner))
+          method = None if function is not None else cache.Method(owner)
+          if type(method) is UserFunction:
+            stack[-1] = TailCall(method, args)
+            continue
+          try:
+            if function is None:
+              stack[-1] = method(*args)
+            else:
+              stack[-1] = function(owner, *args)
+          except CclError as e:
+            e.trace.append(code.origins[pc // 2 - 1])
+            raise
+        elif op == STORE_LOCAL:
+          if frame[arg] is UNDECLARED:
+            StoreOuterCode(code, frame, (0, arg), stack[-1])
+          else:
+            frame[arg] = stack[-1]
+        elif op == POP:
+          pop()
+        elif op == JUMP_IF_FALSE:
+          if not pop():
+            pc = arg
+        elif op == JUMP:
+          pc = arg
+        elif op == POP_UNDER:
+          value = pop()
+          stack[-1] = value
+        elif op == JUMP_IF_FALSE_OR_POP:
+          if stack[-1]:
+            pop()
+          else:
+            pc = arg
+        elif op == JUMP_IF_TRUE_OR_POP:
+          if stack[-1]:
+            pc = arg
+          else:
+            pop()
+        elif op == RETURN_OP:
+          value = pop()
+          if arg:
+            raise ReturnException(value)
+          if not calls:
+            return value
+          if type(value) is TailCall:
+            function = value.function
+            if type(function) is UserFunction and type(function.body) is Code:
+              code = function.body
+              frame = function.Frame(value.args)
+              stack = []
+              pc = 0
+              break
+            code, frame, stack, pc = calls.pop()
+            try:
+              value = function(*value.args)
+            except CclError as e:
+              e.trace.append(code.origins[pc // 2 - 1])
+              raise
+          else:
+            code, frame, stack, pc = calls.pop()
+          stack[-1] = value
+          break
+        elif op == LOAD_DEREF:
+          depth, index = code.slots[arg]
+          outer = frame
+          for _ in range(depth):
+            outer = outer[0]
+          value = outer[index]
+          if value is UNDECLARED:
+            value = LoadOuterCode(code, frame, code.slots[arg])
+          push(value)
+        elif op == STORE_DEREF:
+          depth, index = code.slots[arg]
+          outer = frame
+          for _ in range(depth):
+            outer = outer[0]
+          if outer[index] is UNDECLARED:
+            StoreOuterCode(code, frame, code.slots[arg], stack[-1])
+          else:
+            outer[index] = stack[-1]
+        elif op == STORE_GLOBAL:
+          if names[arg] in table:
+            table[names[arg]] = stack[-1]
+          elif names[arg] in scope:
+            scope[names[arg]] = stack[-1]
+          else:
+            raise CclError('%r is not defined' % names[arg])
+        elif op == DECLARE_GLOBAL:
+          scope.Declare(names[arg])
+        elif op == DECLARE_LOCAL:
+          frame[arg] = stack[-1]
+        elif op == BUILD_LIST:
+          start = len(stack) - arg
+          items = stack[start:]
+          del stack[start:]
+          push(List(items))
+        elif op == MAKE_FUNCTION:
+          body = constants[arg]
+          push(UserFunction(frame, body.arity, body.padding, body, body.origin))
+        elif op == SET_ATTR:
+          value = pop()
+          try:
+            setattr(stack[-1], names[arg], value)
+          except AttributeError:
+            raise CclError('Cannot set attribute ' + names[arg][2:])
+          stack[-1] = nil
+        elif op == TRUNCATE:
+          del stack[arg:]
+        elif op == BREAK_OP:
+          raise BreakException()
+        else:
+          raise CclError('Unrecognized opcode %r' % op)
+    except BreakException:
+      # As in Evaluate, a break ends the innermost while that is running,
+      # here or in a caller, and is raised on if there is none.
+      while True:
+        loop = BreakTarget(code, pc)
+        if loop is not None:
+          break
+        if not calls:
+          raise
+        code, frame, stack, pc = calls.pop()
+      del stack[loop[2]:]
+      pc = loop[1]
+    except CclError as e:
+      if not e.trace:
+        e.trace.append(code.origins[pc // 2 - 1])
+      for code, _, _, pc in reversed(calls):
+        e.trace.append(code.origins[pc // 2 - 1])
+      raise
+
+
+def Disassemble(code):
+  """Human readable listing of code and every function nested in it."""
+  lines = []
+  codes = [code]
+  for code in codes:
+    if lines:
+      lines.append('')
+    lines.append('%s arity %d locals %d' % (code.name, code.arity, len(code.padding)))
+    for pc in range(0, len(code.ops), 2):
+      op = code.ops[pc]
+      arg = code.ops[pc + 1]
+      if op in (LOAD_CONST, MAKE_FUNCTION):
+        value = code.constants[arg]
+        if isinstance(value, Code):
+          codes.append(value)
+          detail = value.name
+        elif type(value) in METHODS:
+          detail = repr(value)
+        else:
+          detail = str(value)
+      elif op in (LOAD_GLOBAL, STORE_GLOBAL, DECLARE_GLOBAL, GET_ATTR, SET_ATTR):
+        detail = code.names[arg]
+      elif op in (LOAD_DEREF, STORE_DEREF):
+        detail = 'depth %d index %d' % code.slots[arg]
+      elif op == CALL_METHOD or op == TAIL_CALL_METHOD:
+        cache, count = code.sites[arg]
+        detail = '%s %d' % (cache.attr, count)
+      else:
+        detail = ''
+      lines.append(('%4d %4d %-16s %-4s %s' % (
+          code.origins[pc // 2].LineNumber(), pc, OPCODES[op], arg, detail)).rstrip())
+  return '\n'.join(lines) + '\n'
+
+
+def ExecuteCode(scope, node):
+  layout = FrameLayout(None, (), node, scope)
+  return RunModule(Assemble(node, layout), None)
+
+
+CACHE_MAGIC = b'ccl-parse-cache 2\n'
+
+
+def InterpreterVersion():
+  """
+  A digest of this interpreter's own source and the Python running it, so
+  that cached parses are dropped whenever either changes.
+  """
+  global INTERPRETER_VERSION
+  if INTERPRETER_VERSION is None:
+    digest = hashlib.sha256(CACHE_MAGIC)
+    digest.update(sys.version.encode('utf-8'))
+    try:
+      with open(__file__, 'rb') as f:
+        digest.update(f.read())
+    except (OSError, NameError):
+      pass
+    INTERPRETER_VERSION = digest.digest()
+  return INTERPRETER_VERSION
+
+INTERPRETER_VERSION = None
+
+
+def CachePath(directory, string):
+  digest = hashlib.sha256(InterpreterVersion())
+  digest.update(string.encode('utf-8', 'surrogatepass'))
+  return os.path.join(directory, digest.hexdigest() + '.cclc')
+
+
+def ParseCached(string, filename, directory):
+  """
+  Parse, reusing a tree saved in directory by an earlier call on the same
+  source text and interpreter version.
+
+  A missing or unreadable entry is parsed afresh and rewritten; the new
+  entry is written to a temporary file and renamed into place so that
+  concurrent runs never see a partial file. A directory that cannot be
+  written to just means nothing is cached.
+  """
+  if not isinstance(string, str):
+    string = string.read()
+
+  path = CachePath(directory, string)
+
+  try:
+    with open(path, 'rb') as f:
+      data = f.read()
+    if data.startswith(CACHE_MAGIC):
+      tree = FlatTree.FromBytes(data[len(CACHE_MAGIC):], SourceFile(filename, string))
+      return tree.Node()
+  except (OSError, EOFError, ValueError, TypeError, IndexError):
+    pass
+
+  tree = Parse(string, filename, flat=True)
+
+  try:
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as f:
+        f.write(CACHE_MAGIC + tree.ToBytes())
+      os.replace(temp, path)
+    except BaseException:
+      os.unlink(temp)
+      raise
+  except OSError:
+    pass
+
+  return tree.Node()
+
+
+# 'evaluate' is the original tree walker, kept as a reference for
+# differential testing of the compiled form. 'vm' assembles and runs from
+# explicit stacks, so only memory limits how deeply a program nests or
+# recurses; the other modes recurse in Python.
+MODES = {
+    'compile': Execute,
+    'vm': ExecuteCode,
+    'evaluate': Evaluate,
+}
+
+
+def Load(string, filename=None, cache=None, passes=PASSES):
+  """
+  Parse a program, keeping parsed trees in the directory cache if given,
+  and optimize it with passes.
+  """
+  filename = filename or '<unknown>'
+  if cache is None:
+    node = Parse(string, filename)
+  else:
+    node = ParseCached(string, filename, cache)
+  return Optimize(node, passes)
+
+
+def Run(string, filename=None, mode='compile', cache=None, passes=PASSES):
+  """Load a program and run it in mode, one of MODES."""
+  return MODES[mode](ROOT_SCOPE, Load(string, filename, cache, passes))
+
+
+def RunX(string, filename=None, mode='compile', cache=None, passes=PASSES, run=Run):
+  try:
+    return run(string, filename, mode, cache, passes)
   except CclError as e:
     sys.stderr.write('***** Error *****\n' + str(e))
     exit(1)
 
 
+class Profiler(object):
+  """
+  Call counts and time per function and builtin, and hits per source line,
+  for a program run by the reference Evaluate.
+
+  While Run is going the module's Evaluate is swapped for this profiler's,
+  which counts and times what it is given and leaves the rest to the plain
+  Evaluate. Evaluate itself has no hooks, so it costs nothing when nothing
+  is being profiled.
+
+  Functions are keyed like cProfile's, by (filename, line, name): a ccl
+  function by the origin of its Function node and the name it was first
+  bound to, and a builtin by ('~', 0, name).
+  """
+
+  def __init__(self, clock=time.perf_counter):
+    self.clock = clock
+    # key -> [calls, primitive calls, own seconds, total seconds]
+    self.functions = dict()
+    # (caller key, key) -> [calls, primitive calls, own seconds, total seconds]
+    self.callers = dict()
+    # (filename, line) -> hits, and the origin of a statement on the line.
+    self.lines = dict()
+    self.line_origins = dict()
+    # Call stacks as a tree of (parent path, key), and own seconds per path.
+    self.paths = dict()
+    self.path_keys = []
+    self.path_seconds = []
+    # Frames of [key, path, start, seconds in callees].
+    self.stack = []
+    self.active = dict()
+    self.statements = dict()
+    self.names = dict()
+    self.keys = dict()
+    self.evaluate = None
+
+  def Run(self, string, filename=None, mode='evaluate', cache=None, passes=PASSES):
+    """Load a program and run it in evaluate mode, the only one profiled."""
+    global Evaluate
+    if mode != 'evaluate':
+      raise ValueError('Profiler runs programs in evaluate mode, not ' + mode)
+    node = Load(string, filename, cache, passes)
+    self.Prepare(node)
+    self.evaluate = Evaluate
+    Evaluate = self.Evaluate
+    self.Enter((node.origin.filename, 0, '<module>'))
+    try:
+      return Evaluate(ROOT_SCOPE, node)
+    finally:
+      self.Exit()
+      Evaluate = self.evaluate
+
+  def Prepare(self, node):
+    """Find the statements and the names functions are bound to in node."""
+    self.names.update(FunctionNames(node))
+    for key, origin in StatementOrigins(node).items():
+      line = (origin.filename, origin.LineNumber())
+      self.statements[key] = line
+      self.line_origins.setdefault(line, origin)
+
+  def Evaluate(self, scope, node):
+    line = self.statements.get(id(node))
+    if line is not None:
+      self.lines[line] = self.lines.get(line, 0) + 1
+
+    kind = node.kind
+    if kind == CALL_NODE:
+      function = Evaluate(scope, node.function)
+      args = Evaluate(scope, node.arguments)
+      return self.Call(function, args, self.Key(function), node.origin)
+    elif kind == METHOD_CALL_NODE:
+      arguments = node.arguments
+      owner = Evaluate(scope, node.receiver)
+      try:
+        method = Attribute(owner, 'XX' + node.value)
+      except AttributeError:
+        error = CclError('Object has no attribute ' + node.value)
+        error.trace.append(arguments.origin)
+        raise error
+      args = [Evaluate(scope, n) for n in arguments.children]
+      key = self.Key(method)
+      if key is None:
+        key = ('~', 0, TypeName(owner) + '.' + node.value)
+      return self.Call(method, args, key, node.origin)
+    return self.evaluate(scope, node)
+
+  def Key(self, function):
+    """The key of a ccl or builtin function, or None for a method."""
+    if type(function) is ReferenceFunction:
+      origin = function.origin
+      origin_key = self.keys.get(id(origin))
+      if origin_key is None or origin_key[0] is not origin:
+        origin_key = self.keys[id(origin)] = (origin, FunctionKey(origin, self.names))
+      return origin_key[1]
+    elif type(function) is BuiltinFunction:
+      return ('~', 0, function.function.__name__)
+
+  def Call(self, function, args, key, origin):
+    """Call function as Evaluate does, timed under key."""
+    self.Enter(key)
+    try:
+      return function(*args)
+    except ReturnException as e:
+      return e.value
+    except CclError as e:
+      e.trace.append(origin)
+      raise
+    finally:
+      self.Exit()
+
+  def Enter(self, key):
+    parent = self.stack[-1][1] if self.stack else -1
+    path = self.paths.get((parent, key))
+    if path is None:
+      path = self.paths[(parent, key)] = len(self.path_keys)
+      self.path_keys.append((parent, key))
+      self.path_seconds.append(0.0)
+    self.active[key] = self.active.get(key, 0) + 1
+    self.stack.append([key, path, self.clock(), 0.0])
+
+  def Exit(self):
+    key, path, start, inner = self.stack.pop()
+    seconds = self.clock() - start
+    self.active[key] -= 1
+    # Time in a recursive call is already in the total of the outermost.
+    primitive = not self.active[key]
+    caller = self.stack[-1][0] if self.stack else None
+    for stats in (self.functions.setdefault(key, [0, 0, 0.0, 0.0]),
+                  self.callers.setdefault((caller, key), [0, 0, 0.0, 0.0])):
+      stats[0] += 1
+      stats[2] += seconds - inner
+      if primitive:
+        stats[1] += 1
+        stats[3] += seconds
+    self.path_seconds[path] += seconds - inner
+    if self.stack:
+      self.stack[-1][3] += seconds
+
+  def Stats(self):
+    """The profile as the dict pstats.Stats loads from a file."""
+    stats = dict()
+    for key, (calls, primitive, own, total) in self.functions.items():
+      stats[key] = (primitive, calls, own, total, dict())
+    for (caller, key), (calls, primitive, own, total) in self.callers.items():
+      if caller is not None:
+        stats[key][4][caller] = (calls, primitive, own, total)
+    return stats
+
+  def DumpStats(self, path):
+    """Write the profile to path for pstats.Stats or snakeviz."""
+    with open(path, 'wb') as f:
+      marshal.dump(self.Stats(), f)
+
+  def FlameGraph(self):
+    """
+    The profile as collapsed stacks, one 'outer;inner microseconds' line
+    per call path, the input of flamegraph.pl and speedscope.
+    """
+    lines = []
+    for path, seconds in enumerate(self.path_seconds):
+      microseconds = int(round(seconds * 1e6))
+      if not microseconds:
+        continue
+      names = []
+      while path >= 0:
+        path, key = self.path_keys[path]
+        names.append(FunctionName(key).replace(';', ','))
+      lines.append('%s %d\n' % (';'.join(reversed(names)), microseconds))
+    return ''.join(sorted(lines))
+
+  def Report(self, limit=20):
+    """The functions taking the most time and the most run lines."""
+    lines = ['%8s %10s %10s  %s\n' % ('calls', 'total s', 'own s', 'function')]
+    functions = sorted(self.functions.items(), key=lambda item: -item[1][2])
+    for key, (calls, primitive, own, total) in functions[:limit]:
+      count = str(calls) if calls == primitive else '%d/%d' % (calls, primitive)
+      lines.append('%8s %10.6f %10.6f  %s\n' % (count, total, own, FunctionName(key)))
+    lines.append('\n%8s  %s\n' % ('hits', 'line'))
+    hits = sorted(self.lines.items(), key=lambda item: (-item[1], item[0]))
+    for (filename, line), count in hits[:limit]:
+      text = self.line_origins[filename, line].Line().strip()
+      lines.append('%8d  %s:%d  %s\n' % (count, filename, line, text))
+    return ''.join(lines)
+
+
+def StatementOrigins(node):
+  """
+  The origin of each statement in node by the id of its node: children of
+  Modules and Blocks, and bodies of Functions, ifs and whiles, that are
+  not themselves Blocks.
+  """
+  origins = dict()
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    kind = node.kind
+    if kind == MODULE_NODE or kind == BLOCK_NODE:
+      statements = node.children
+    elif kind == FUNCTION_NODE or kind == WHILE_NODE:
+      statements = [node.body]
+    elif kind == IF_NODE:
+      statements = [node.body] if node.orelse is None else [node.body, node.orelse]
+    else:
+      statements = []
+    for child in statements:
+      if child.kind != BLOCK_NODE:
+        origins[id(child)] = child.origin
+    stack.extend(node.children)
+  return origins
+
+
+def FunctionNames(node):
+  """
+  The name each Function node in node is first bound to, with its origin,
+  by id of its origin. Holding the origin keeps the id from being reused.
+  """
+  names = dict()
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    if node.kind == VAR_NODE:
+      for name, child in zip(node.value, node.children):
+        if child.kind == FUNCTION_NODE:
+          names.setdefault(id(child.origin), (child.origin, name))
+    elif node.kind == ASSIGN_NODE or node.kind == SET_ATTRIBUTE_NODE:
+      if node.children[-1].kind == FUNCTION_NODE:
+        names.setdefault(id(node.children[-1].origin), (node.children[-1].origin, node.value))
+    stack.extend(node.children)
+  return names
+
+
+def FunctionKey(origin, names):
+  """The profile key of the function whose Function node has origin."""
+  origin_name = names.get(id(origin))
+  name = origin_name[1] if origin_name is not None and origin_name[0] is origin else '<function>'
+  return (origin.filename, origin.LineNumber(), name)
+
+
+def FunctionName(key):
+  filename, line, name = key
+  if filename == '~':
+    return name
+  return '%s:%d(%s)' % (filename, line, name)
+
+
+class Sampler(object):
+  """
+  A low overhead profile of a running program: a background thread looks
+  at the ccl call stack of the thread running it every interval seconds,
+  and counts how often each stack is seen.
+
+  The stack is read from the Python frames of UserFunction and
+  ReferenceFunction calls and from the call stack RunCode keeps, so it
+  works in every mode and nothing is added to the program's own path.
+  Frames are named like the Profiler's, so their flame graphs compare.
+  """
+
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.counts = dict()
+    self.names = dict()
+    self.labels = dict()
+    self.root = FunctionName(('<unknown>', 0, '<module>'))
+    self.target = None
+    self.thread = None
+    self.stopping = threading.Event()
+
+  def Run(self, string, filename=None, mode='compile', cache=None, passes=PASSES):
+    """Load a program and run it in mode, sampling it."""
+    node = Load(string, filename, cache, passes)
+    self.names.update(FunctionNames(node))
+    self.root = FunctionName((node.origin.filename, 0, '<module>'))
+    self.Start()
+    try:
+      return MODES[mode](ROOT_SCOPE, node)
+    finally:
+      self.Stop()
+
+  def Start(self, target=None):
+    """Start sampling the thread with ident target, by default this one."""
+    self.target = threading.get_ident() if target is None else target
+    self.stopping.clear()
+    self.thread = threading.Thread(target=self.Loop, name='ccl sampler', daemon=True)
+    self.thread.start()
+
+  def Stop(self):
+    self.stopping.set()
+    self.thread.join()
+    self.thread = None
+
+  def Loop(self):
+    while not self.stopping.wait(self.interval):
+      self.Sample()
+
+  def Sample(self):
+    frame = sys._current_frames().get(self.target)
+    if frame is None:
+      return
+    stack = self.Stack(frame)
+    self.counts[stack] = self.counts.get(stack, 0) + 1
+
+  def Stack(self, frame):
+    """The names of the ccl functions running in frame, outermost first."""
+    origins = []
+    while frame is not None:
+      code = frame.f_code
+      if code is USER_FUNCTION_CALL:
+        function = frame.f_locals.get('function')
+        # Code bodies are counted from the calls RunCode keeps.
+        if function is not None and type(function.body) is not Code:
+          origins.append(function.origin)
+      elif code is REFERENCE_FUNCTION_CALL:
+        origins.append(frame.f_locals['self'].origin)
+      elif code is RUN_CODE:
+        local = frame.f_locals
+        origins.append(local['code'].origin)
+        origins.extend(call[0].origin for call in reversed(local['calls']))
+      frame = frame.f_back
+    labels = [self.root]
+    for origin in reversed(origins):
+      if origin is not None:
+        labels.append(self.Label(origin))
+    return tuple(labels)
+
+  def Label(self, origin):
+    origin_label = self.labels.get(id(origin))
+    if origin_label is None or origin_label[0] is not origin:
+      origin_label = self.labels[id(origin)] = (
+          origin, FunctionName(FunctionKey(origin, self.names)))
+    return origin_label[1]
+
+  def FlameGraph(self):
+    """The samples as collapsed stacks, one 'outer;inner count' line each."""
+    return ''.join(sorted(
+        '%s %d\n' % (';'.join(label.replace(';', ',') for label in stack), count)
+        for stack, count in self.counts.items()))
+
+
+USER_FUNCTION_CALL = UserFunction.__call__.__code__
+REFERENCE_FUNCTION_CALL = ReferenceFunction.__call__.__code__
+RUN_CODE = RunCode.__code__
+
+
+class Coverage(object):
+  """
+  The lines of ccl sources that ran and how many times, by filename, for
+  programs run in compile mode.
+
+  Each statement is compiled with a wrapper that counts it, only when the
+  layout it is compiled with has a Coverage, so a run pays one call and
+  increment per statement and code compiled without one pays nothing.
+  Counts add up over every program run with the same Coverage.
+  """
+
+  def __init__(self):
+    # filename -> line -> [hits]
+    self.files = dict()
+    self.sources = dict()
+    # id of each statement node -> its line's counter, while compiling.
+    self.statements = dict()
+
+  def Run(self, string, filename=None, mode='compile', cache=None, passes=PASSES):
+    """Load a program and run it in compile mode, the only one covered."""
+    if mode != 'compile':
+      raise ValueError('Coverage runs programs in compile mode, not ' + mode)
+    node = Load(string, filename, cache, passes)
+    for key, origin in StatementOrigins(node).items():
+      lines = self.files.setdefault(origin.filename, dict())
+      self.sources.setdefault(origin.filename, origin.source)
+      self.statements[key] = lines.setdefault(origin.LineNumber(), [0])
+    try:
+      return Execute(ROOT_SCOPE, node, self)
+    finally:
+      self.statements.clear()
+
+  def Instrument(self, node, function):
+    """function, counting its runs if node is a statement."""
+    counter = self.statements.get(id(node))
+    if counter is None:
+      return function
+
+    def Count(frame):
+      counter[0] += 1
+      return function(frame)
+
+    return Count
+
+  def Json(self):
+    """Hits by line number, as a string, by filename."""
+    return dict(
+        (filename, dict((str(line), lines[line][0]) for line in sorted(lines)))
+        for filename, lines in self.files.items())
+
+  def Dump(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.Json(), f, indent=1)
+      f.write('\n')
+
+  def Report(self):
+    """
+    Each source with the hits of each line that has a statement, and
+    >>>>>> for those that never ran.
+    """
+    out = []
+    for filename in sorted(self.files):
+      lines = self.files[filename]
+      run = sum(1 for counter in lines.values() if counter[0])
+      out.append('%s: %d of %d lines run\n' % (filename, run, len(lines)))
+      for number, text in enumerate(self.sources[filename].string.split('\n'), 1):
+        counter = lines.get(number)
+        if counter is None:
+          mark = ''
+        elif counter[0]:
+          mark = str(counter[0])
+        else:
+          mark = '>>>>>>'
+        out.append(('%6s  %s' % (mark, text)).rstrip() + '\n')
+    return ''.join(out)
+
+
+class Phase(object):
+  """What one phase of a run took."""
+
+  __slots__ = ('name', 'seconds', 'count', 'unit', 'peak', 'allocated', 'net_blocks')
+
+  def __init__(self, name):
+    self.name = name
+    self.seconds = 0.0
+    # Tokens made by lex, or Nodes in the tree after parse and optimize.
+    self.count = None
+    self.unit = ''
+    # Bytes traced by tracemalloc, above what was held when the phase
+    # began: the most at any point, and what was still held at its end.
+    self.peak = None
+    self.allocated = None
+    # Change in the memory blocks Python holds, from sys.getallocatedblocks:
+    # blocks allocated less blocks freed, so negative when a phase frees
+    # more than it allocates. It is not a count of allocations.
+    self.net_blocks = 0
+
+
+class Stats(object):
+  """
+  A program run one phase at a time, lex, parse, optimize, compile or
+  assemble for the modes that do, and run, with what each phase took.
+
+  With memory, tracemalloc traces each phase, which makes them slower.
+  Either way the report has the net change in blocks Python holds over
+  each phase, which is below zero for a phase that frees more than it
+  allocates.
+  """
+
+  def __init__(self, memory=True):
+    self.memory = memory
+    self.phases = []
+
+  def Run(self, string, filename=None, mode='compile', cache=None, passes=PASSES):
+    """Load and run a program like Run, recording each phase."""
+    filename = filename or '<unknown>'
+    if not isinstance(string, str):
+      string = string.read()
+    tracing = self.memory and not tracemalloc.is_tracing()
+    if tracing:
+      tracemalloc.start()
+    try:
+      if cache is None:
+        tokens = self.Phase('lex', lambda: Lex(string, filename))
+        self.phases[-1].count, self.phases[-1].unit = len(tokens), 'tokens'
+        node = self.Phase('parse', lambda: Parse(tokens, filename))
+        del tokens
+      else:
+        node = self.Phase('parse', lambda: ParseCached(string, filename, cache))
+      self.phases[-1].count, self.phases[-1].unit = NodeCount(node), 'nodes'
+      node = self.Phase('optimize', lambda: Optimize(node, passes))
+      self.phases[-1].count, self.phases[-1].unit = NodeCount(node), 'nodes'
+      if mode == 'compile':
+        function = self.Phase('compile', lambda: Compile(node, FrameLayout(None, (), node, ROOT_SCOPE)))
+        return self.Phase('run', lambda: RunModule(function, [None, None]))
+      elif mode == 'vm':
+        code = self.Phase('assemble', lambda: Assemble(node, FrameLayout(None, (), node, ROOT_SCOPE)))
+        return self.Phase('run', lambda: RunModule(code, None))
+      else:
+        return self.Phase('run', lambda: MODES[mode](ROOT_SCOPE, node))
+    finally:
+      if tracing:
+        tracemalloc.stop()
+
+  def Phase(self, name, function):
+    """Call function as the phase name and return what it returns."""
+    phase = Phase(name)
+    self.phases.append(phase)
+    if self.memory:
+      tracemalloc.reset_peak()
+      held = tracemalloc.get_traced_memory()[0]
+    blocks = sys.getallocatedblocks()
+    start = time.perf_counter()
+    try:
+      return function()
+    finally:
+      phase.seconds = time.perf_counter() - start
+      phase.net_blocks = sys.getallocatedblocks() - blocks
+      if self.memory:
+        current, peak = tracemalloc.get_traced_memory()
+        phase.peak = peak - held
+        phase.allocated = current - held
+
+  def Report(self):
+    """A table of the phases, with their total."""
+    def Kilobytes(size):
+      return '-' if size is None else '%.1f' % (size / 1024.0)
+    out = ['%-10s %10s %16s %12s %12s %10s\n' % (
+        'phase', 'ms', 'count', 'peak KB', 'net KB', 'net blocks')]
+    for phase in self.phases:
+      count = '' if phase.count is None else '%d %s' % (phase.count, phase.unit)
+      out.append('%-10s %10.2f %16s %12s %12s %10d\n' % (
+          phase.name, phase.seconds * 1000, count,
+          Kilobytes(phase.peak), Kilobytes(phase.allocated), phase.net_blocks))
+    out.append('%-10s %10.2f %16s %12s %12s %10d\n' % (
+        'total', sum(phase.seconds for phase in self.phases) * 1000, '',
+        Kilobytes(max(phase.peak for phase in self.phases) if self.memory and self.phases else None),
+        Kilobytes(sum(phase.allocated for phase in self.phases) if self.memory else None),
+        sum(phase.net_blocks for phase in self.phases)))
+    return ''.join(out)
+
+
+def NodeCount(node):
+  """The number of Nodes in the tree node."""
+  count = 0
+  stack = [node]
+  while stack:
+    node = stack.pop()
+    count += 1
+    stack.extend(node.children)
+  return count
+
+
 ### Test
 
+# The globals of the root scope before the tests, which declare their own
+# there. They are put back in the same dict once the tests are done, so
+# programs run later see only the builtins.
+root_table = dict(ROOT_SCOPE.table)
+
 origin = Origin('<test>', """
 hello world!
 """, 1)
@@ -871,20 +4010,20 @@ while i.LessThan(10)
 assert node == Node('Module', None, [
     Node('Assign', 'i', [Node('Number', 0, [])]),
     Node('while', None, [
-        Node('Call', None, [
-            Node('GetAttribute', 'LessThan', [Node('Name', 'i', [])]),
+        Node('MethodCall', 'LessThan', [
+            Node('Name', 'i', []),
             Node('Arguments', None, [
                 Node('Number', 10, []),
             ]),
         ]),
         Node('Block', None, [
-            Node('Call', None, [
-                Node('GetAttribute', 'Print', [Node('Name', 'i', [])]),
+            Node('MethodCall', 'Print', [
+                Node('Name', 'i', []),
                 Node('Arguments', None, []),
             ]),
             Node('Assign', 'i', [
-                Node('Call', None, [
-                    Node('GetAttribute', 'Add', [Node('Name', 'i', [])]),
+                Node('MethodCall', 'Add', [
+                    Node('Name', 'i', []),
                     Node('Arguments', None, [
                         Node('Number', 1, []),
                     ]),
@@ -938,7 +4077,738 @@ Assert(xs.String().Equal('[0, 1, 2]'), xs.String())
 
 """)
 
+PROGRAM = r"""
+var Fib = \ n
+  if n.LessThan(2)
+    return n
+  return Fib(n.Subtract(1)).Add(Fib(n.Subtract(2)))
+
+var count = 0
+while true
+  if count.Equal(5)
+    break
+  count = count.Add(1)
+
+[Fib(10), count, "x".Multiply(3)]
+"""
+
+for mode in MODES:
+  assert Run(PROGRAM, '<test>', mode) == List([55, 5, 'xxx']), mode
+
+# A return in an argument returns from the enclosing function, not from
+# the call it is an argument of.
+RETURN_PROGRAM = r"""
+var log = []
+var Push = \ n
+  log.Push(n.LessThan(0) and return "neg")
+  "pos"
+var Call = \ n
+  Assert(n.LessThan(0) and return "neg")
+  "pos"
+var m = (0).Subtract(1)
+[Push(m), Push(1), Call(m), log]
+"""
+
+for mode in MODES:
+  assert str(Run(RETURN_PROGRAM, '<test>', mode)) == '[neg, pos, neg, [false]]', mode
+
+# A local is declared when its var runs, not before, in every mode.
+SCOPE_PROGRAM = r"""
+var x = 1
+var Shadow = \
+  var y = x
+  var x = 2
+  [y, x]
+var Assign = \
+  x = 3
+  var x = 4
+  x
+var Self = \
+  var x = x
+  x
+var Later = \
+  var Get = \
+    x
+  var before = Get()
+  var x = 5
+  [before, Get()]
+var Indirect = \
+  var Get = \ . x
+  var x = [Get()]
+  x
+var Again = \
+  var Get = \ . y
+  var out = []
+  var y = 0
+  var i = 0
+  while i.LessThan(2)
+    var y = [Get()]
+    out.Push(y)
+    i = i.Add(1)
+  out
+[Shadow(), Assign(), x, Self(), Later(), Indirect(), Again()]
+"""
+
+for mode in MODES:
+  assert str(Run(SCOPE_PROGRAM, '<test>', mode)) == (
+      '[[1, 2], 4, 3, nil, [3, 5], [nil], [[nil], [nil]]]'), mode
+
+for program in (
+    'var f = \\\n  if false\n    var z = 1\n  z\nf()',
+    'var f = \\ z . z\nf()'):
+  errors = []
+  for mode in MODES:
+    try:
+      Run(program, '<test>', mode)
+    except CclError as e:
+      errors.append(e.message)
+  assert errors == ["'z' is not defined"] * len(MODES), (program, errors)
+
+PROGRAM = r"""
+var Find = \ xs x
+  var i = 0
+  while true
+    if i.Equal(xs.Size())
+      break
+    if xs.Get(i).Equal(x)
+      return i
+    i = i.Add(1)
+  return (0).Subtract(1)
+
+var Sign = \ n
+  n.LessThan(0) and return "-"
+  return "+"
+
+var last = 0
+var value = while true
+  if last.Equal(3)
+    break
+  last = last.Add(1)
+
+[Find("abc", "c"), Find("abc", "d"), Sign((0).Subtract(2)), Sign(2), value]
+"""
+
+for mode in MODES:
+  assert Run(PROGRAM, '<test>', mode) == List([
+      2, -1, '-', '+', 3]), mode
+
+for mode in MODES:
+  try:
+    Run("undefined_name", '<test>', mode)
+  except CclError as e:
+    assert str(e) == """'undefined_name' is not defined
+in <test> on line 1 column 1
+undefined_name
+*
+""", (mode, str(e))
+  else:
+    assert False, "undefined_name should have raised error in mode " + mode
+
+node = Parse("""
+var MakeCounter = \\
+  var count = 0
+  return \\
+    count = count.Add(1)
+    return \\ . count
+""", '<test>')
+
+layout = FrameLayout(None, (), node, ROOT_SCOPE)
+inner = FrameLayout(layout, (), node.children[0].children[0].children[0], ROOT_SCOPE)
+assert inner.slots == {'count': 2}, inner.slots
+assert inner.Resolve('count') == (0, 2)
+assert inner.Resolve('MakeCounter') is None
+assert inner.Resolve('Assert') is None
+
+assert Run("""
+var MakeCounter = \\
+  var count = 0
+  return \\
+    count = count.Add(1)
+    return \\ . count
+var counter = MakeCounter()
+counter()
+counter()
+counter()()
+""") == 3
+
+try:
+  Run("var NeverCalled = \\ . undefined_name", '<test>')
+except CclError as e:
+  assert str(e).startswith("'undefined_name' is not defined"), str(e)
+else:
+  assert False, "undefined_name should have raised error at resolve time"
+
+node = Parse("""
+var Square = \\ x . x.Multiply(x)
+""", '<test>')
+
+code = Assemble(node, FrameLayout(None, (), node, ROOT_SCOPE))
+
+assert Disassemble(code) == """<module> arity 0 locals 0
+   2    0 DeclareGlobal    0    Square
+   2    2 MakeFunction     0    <function line 2>
+   2    4 StoreGlobal      0    Square
+   2    6 Pop              0
+   2    8 LoadConst        1    nil
+   2   10 Return           0
+
+<function line 2> arity 1 locals 0
+   2    0 LoadLocal        2
+   2    2 LoadLocal        2
+   2    4 TailCallMethod   0    XXMultiply 1
+   2    6 Return           0
+   2    8 Return           0
+""", Disassemble(code)
+
+# A break ends the while running when it is reached, even from a function
+# called in it, and one outside any while fails only if it runs.
+# The signals are bits, and no opcode may rebind them.
+assert (RETURN, BREAK) == (1, 2), (RETURN, BREAK)
+
+BREAK_PROGRAM = r"""
+var Stop = \ x
+  if x.Equal(3)
+    break
+  x
+var Never = \
+  break
+var n = 0
+var out = []
+while true
+  n = n.Add(1)
+  out.Push([1, Stop(n)])
+[n, out]
+"""
+
+for mode in MODES:
+  assert str(Run(BREAK_PROGRAM, '<test>', mode)) == '[3, [[1, 1], [1, 2]]]', mode
+  for program in ("break", "var Stop = \\\n  break\nStop()"):
+    try:
+      Run(program, '<test>', mode)
+    except CclError as e:
+      assert str(e).startswith('break outside of while'), (mode, str(e))
+    else:
+      assert False, "break outside of while should have raised error"
+  for program in ("return 5", "[return 5]", "while true\n  return 5\n6"):
+    try:
+      Run(program, '<test>', mode)
+    except ReturnException as e:
+      assert e.value == 5, (mode, program, e.value)
+    else:
+      assert False, "return outside of a function should have raised in mode " + mode
+
+assert Attribute(1, 'XXLessThan')(2) is True
+assert Attribute('a', 'XXEqual')('b') is False
+assert Attribute(1, 'XXEqual')(1.0) is True
+assert Attribute(1, 'XXEqual')(True) is False
+assert ToString(True) == 'true' and ToString(2.5) == '2.5' and ToString(nil) == 'nil'
+assert ConvertValue(True) is True and ConvertValue(None) is nil
+values = [1, 2.5, 'a', True, nil]
+xs = ConvertValue(values)
+xs.XXPush(3)
+assert ToString(xs) == ToString(xs) == '[1, 2.5, a, true, nil, 3]', ToString(xs)
+assert values == [1, 2.5, 'a', True, nil]
+xs = ConvertValue([1, None, [2, ['b']]])
+assert ToString(xs) == ToString(xs) == '[1, nil, [2, [b]]]', ToString(xs)
+assert type(xs.value[2]) is List and type(xs.value[2].value) is list
+try:
+  Attribute(1, 'XXSize')
+except AttributeError:
+  pass
+else:
+  assert False, "Number.Size should not exist"
+
+for mode in MODES:
+  assert Run("(5).Add(5).Equal(10)", '<test>', mode) is True, mode
+  assert Run("var o = Create()\no.x = 1", '<test>', mode) is nil, mode
+  assert str(Run(
+      '[[1].Equal([true]), [1, "a", [nil]].Equal([1.0, "a", [nil]]), [1].Equal([1, 2])]',
+      '<test>', mode)) == '[false, true, false]', mode
+
+for mode in MODES:
+  assert Run("""
+var o = Create()
+o.x = 5
+o.x
+""", '<test>', mode) == 5, mode
+
+  try:
+    Run("(5).x = 1", '<test>', mode)
+  except CclError as e:
+    assert str(e).startswith('Cannot set attribute x'), str(e)
+  else:
+    assert False, "Setting an attribute on a Number should have raised error"
+
+for mode in MODES:
+  assert Run("""
+var Show = \\ x . x.String()
+var o = Create()
+o.String = \\ . "o"
+var out = []
+var i = 0
+while i.LessThan(2)
+  out.Push(Show(1))
+  out.Push(Show("a"))
+  out.Push(Show(nil))
+  out.Push(Show(true))
+  out.Push(Show([2]))
+  out.Push(Show(o))
+  out.Push(Show(2.5))
+  i = i.Add(1)
+out.String()
+""", '<test>', mode) == (
+      '[1, a, nil, true, [2], o, 2.5, 1, a, nil, true, [2], o, 2.5]'), mode
+
+  try:
+    Run("var f = \\ x . x.Missing()\nf(1)", '<test>', mode)
+  except CclError as e:
+    assert str(e).startswith('Object has no attribute Missing'), str(e)
+  else:
+    assert False, "Calling a missing method should have raised error"
+
+  try:
+    Run("""
+var Inner = \\ x
+  var y = x.Missing()
+  y
+var Outer = \\ x . [Inner(x)]
+Outer(1)""", '<test>', mode)
+  except CclError as e:
+    assert str(e) == """Object has no attribute Missing
+in <test> on line 3 column 12
+  var y = x.Missing()
+           *
+in <test> on line 5 column 25
+var Outer = \\ x . [Inner(x)]
+                        *
+in <test> on line 6 column 6
+Outer(1)
+     *
+""", (mode, str(e))
+  else:
+    assert False, "Calling a missing method should have raised error"
+
+cache = InlineCache('String', None)
+for value in (1, 'a', 2, nil, True, List([]), UserObject()):
+  cache.Method(value)
+assert sorted(t.__name__ for t in cache.methods) == ['Nil', 'bool', 'int', 'str']
+
+source = SourceFile('<test>', "a\nbc\n\nd")
+assert source.LineStarts() == [0, 2, 5, 6], source.LineStarts()
+assert [source.Origin(p).LineNumber() for p in range(8)] == [1, 1, 2, 2, 2, 3, 4, 4]
+assert [source.Origin(p).Line() for p in range(8)] == ['a', 'a', 'bc', 'bc', 'bc', '', 'd', 'd']
+assert source.Origin(4).ColumnNumber() == 3
+
+def LexDifference(string):
+  """First pair of (type, value, position) that Lex and ReferenceLex disagree on."""
+  tokens = [(t.type, t.value, t.position) for t in Lex(string, '<test>')]
+  reference = [(t.type, t.value, t.position) for t in ReferenceLex(string, '<test>')]
+  for pair in list(zip(tokens, reference)) + [(len(tokens), len(reference))]:
+    if pair[0] != pair[1]:
+      return pair
+
+for string in (PROGRAM, r'''
+  # leading comment
+var s = "a\tb\\\"c\x41é\101\q"  # trailing
+var r = r'\n' .5 1. 2.25
+var t = """x
+  y"""
+
+if (s.Size()
+    .Equal(3))
+    # comment only
+
+  f(x, [1,
+      2])
+  # dedent
+r.Print() ; s.Print()
+''', "a\n  b\n    c\n  d\ne", "x\n  y\n  # z", "x\n  y\n"):
+  assert LexDifference(string) is None, LexDifference(string)
+
+assert Lex(r'"a\tb\x41é\q"', '<test>')[0].value == 'a\tbAé\\q'
+
+for size in (1, 2, 3, 7):
+  chunks = [PROGRAM[i:i + size] for i in range(0, len(PROGRAM), size)]
+  assert [(t.type, t.value, t.position) for t in LexStream(chunks, '<test>')] == [
+      (t.type, t.value, t.position) for t in Lex(PROGRAM, '<test>')], size
+
+try:
+  list(LexStream(['"""abc', '\n\n', ''], '<test>'))
+except LexError as e:
+  assert str(e).startswith('Missing quotes for: """\nin <test> on line 1 column 1'), str(e)
+else:
+  assert False, "Unterminated string should have raised error"
+
+import io
+assert Parse(io.StringIO(PROGRAM), '<test>') == Parse(PROGRAM, '<test>')
+
+import shutil
+try:
+  cache = tempfile.mkdtemp()
+except OSError:
+  # Where no temporary directory can be made, such as on a read-only or
+  # full disk, the cache's round trip is left untested.
+  cache = None
+if cache is not None:
+  try:
+    node = Parse(PROGRAM, '<test>')
+    assert ParseCached(PROGRAM, '<test>', cache) == node
+    assert os.listdir(cache) == [os.path.basename(CachePath(cache, PROGRAM))]
+
+    loaded = ParseCached(io.StringIO(PROGRAM), '<test>', cache)
+    assert loaded == node
+    assert [n.origin.LocationMessage() for n in loaded.children] == [
+        n.origin.LocationMessage() for n in node.children]
+
+    with open(CachePath(cache, PROGRAM), 'wb') as f:
+      f.write(CACHE_MAGIC + b'\x00')
+    assert ParseCached(PROGRAM, '<test>', cache) == node
+    assert ParseCached(PROGRAM, '<test>', cache) == node
+
+    for mode in sorted(MODES):
+      assert Run(PROGRAM, '<test>', mode, cache) == Run(PROGRAM, '<test>', mode)
+  finally:
+    shutil.rmtree(cache, ignore_errors=True)
+
+def Optimized(string, passes=PASSES):
+  return Optimize(Parse(string, '<test>'), passes)
+
+assert Optimized('(1).Add(2)') == Parse('3', '<test>')
+assert Optimized('"ab".Multiply((1).Add(1)).Size().String()') == Parse('"4"', '<test>')
+assert Optimized('(1).LessThan(2)') == Parse('true', '<test>')
+assert Optimized('(1).Add("a")') == Parse('(1).Add("a")', '<test>')
+assert Optimized('(1).Print()') == Parse('(1).Print()', '<test>')
+assert Optimized('if (1).LessThan(0)\n  f()\nelse\n  g()') == Parse('g()', '<test>')
+assert Optimized('if nil\n  f()') == Parse('nil', '<test>')
+assert Optimized('while false\n  f()') == Parse('nil', '<test>')
+assert Optimized('var true = 0\nif true\n  1') == Parse('var true = 0\nif true 1', '<test>')
+assert Optimized('if false\n  var x = 1') == Parse('if false var x = 1', '<test>')
+assert Optimized('\\ a\n  var x = 1, y = a.Add(1), z = \\ . 2, w = 3\n  w') == Parse(
+    '\\ a\n  var y = a.Add(1), w = 3\n  w', '<test>')
+assert Optimized('(1).Add(2)', ['blocks']) == Parse('(1).Add(2)', '<test>')
+assert Optimized('"ab".Multiply(1000000000)') == Parse('"ab".Multiply(1000000000)', '<test>')
+assert Optimized('"ab".Multiply(512)') == Parse(repr('ab' * 512), '<test>')
+
+OPTIMIZER_PROGRAM = r"""
+var Classify = \ n
+  var unused = "u", also = \ . unused
+  var label = if (2).Equal(2)
+    "two"
+  if n.LessThan((10).Subtract(5))
+    return "low".Multiply(1)
+  if false
+    return "never"
+  else
+    "high"
+
+var Count = \ n
+  var i = 0
+  while false
+    i = i.Add(100)
+  while i.LessThan(n)
+    i = i.Add((1).Add(0))
+  i
+
+Classify(1).Print()
+Classify(9).Print()
+[Classify(3), Classify(7), Count(4), (2).Add(3).LessThan(6), "ab".Get(1), "a".Equal("a")]
+"""
+
+import contextlib
+# Each pass alone and then all of them, each in the next mode in turn, do
+# what the unoptimized program does in evaluate.
+def RunOptimized(mode, passes):
+  out = io.StringIO()
+  with contextlib.redirect_stdout(out):
+    result = Run(OPTIMIZER_PROGRAM, '<test>', mode, passes=passes)
+  return str(result), out.getvalue()
+
+expected = RunOptimized('evaluate', ())
+modes = sorted(MODES)
+for i, passes in enumerate([(name,) for name in PASSES] + [PASSES]):
+  mode = modes[i % len(modes)]
+  assert RunOptimized(mode, passes) == expected, (mode, passes)
+
+TAIL_PROGRAM = r"""
+var Loop = \ n acc
+  if n.Equal(0)
+    return acc
+  return Loop(n.Subtract(1), acc.Add(1))
+
+var Even = \ n
+  if n.Equal(0)
+    return true
+  Odd(n.Subtract(1))
+var Odd = \ n
+  if n.Equal(0)
+    return false
+  Even(n.Subtract(1))
+
+var Make = \ x
+  x.String()
+  Create()
+
+var counter = Create()
+counter.Down = \ n
+  if n.Equal(0)
+    return "done"
+  counter.Down(n.Subtract(1))
+
+Make(1).x = 5
+[Loop(300, 0), Even(301), Loop(0, nil), counter.Down(300)]
+"""
+
+# With the recursion limit well under the calls made, the program only
+# finishes if tail calls run in constant stack depth.
+frame, depth = sys._getframe(), 0
+while frame is not None:
+  frame, depth = frame.f_back, depth + 1
+limit = sys.getrecursionlimit()
+sys.setrecursionlimit(depth + 150)
+try:
+  for mode in ('compile', 'vm'):
+    assert str(Run(TAIL_PROGRAM, '<test>', mode)) == '[300, false, nil, done]', mode
+finally:
+  sys.setrecursionlimit(limit)
+
+def Chain(depth):
+  """false or true and false or ... depth, nested on the right as a generator might write it."""
+  node = Node('Number', depth, [], origin)
+  for i in range(depth):
+    test = Node('Name', 'true' if i % 2 else 'false', [], origin)
+    node = Node('and' if i % 2 else 'or', None, [test, node], origin)
+  return Node('Module', None, [node], origin)
+
+assert ExecuteCode(ROOT_SCOPE, Chain(15)) == Evaluate(ROOT_SCOPE, Chain(15)) == 15
+assert ExecuteCode(ROOT_SCOPE, Chain(400)) == 400
+
+assert Run("""
+var Sum = \\ n
+  if n.Equal(0)
+    return 0
+  n.Add(Sum(n.Subtract(1)))
+Sum(400)
+""", '<test>', 'vm') == 80200
+
+assert Parse('a = a and b or c and d or e', '<test>').children[0] == Node('Assign', 'a', [
+    Node('or', None, [
+        Node('and', None, [Node('Name', 'a', []), Node('Name', 'b', [])]),
+        Node('or', None, [
+            Node('and', None, [Node('Name', 'c', []), Node('Name', 'd', [])]),
+            Node('Name', 'e', []),
+        ]),
+    ]),
+])
+
+assert Run(' or '.join(['true and false'] * 300) + ' or 7', '<test>', 'vm') == 7
+assert Run('(' * 300 + '8' + ')' * 300, '<test>', 'vm') == 8
+assert Run(''.join(' ' * i + 'if true\n' for i in range(200)) + ' ' * 200 + '9\n', '<test>', 'vm') == 9
+
+# Functions nested 300 deep assemble and run in vm mode under a recursion
+# limit that assembling them recursively would exceed.
+frame, depth = sys._getframe(), 0
+while frame is not None:
+  frame, depth = frame.f_back, depth + 1
+limit = sys.getrecursionlimit()
+sys.setrecursionlimit(depth + 150)
+try:
+  assert Run('var f = ' + '\\ . ' * 300 + '10\nf' + '()' * 300, '<test>', 'vm') == 10
+finally:
+  sys.setrecursionlimit(limit)
+
+node = Parse('if a b else c', '<test>').children[0]
+assert node.kind == IF_NODE and node.orelse.value == 'c'
+assert node.children == [node.test, node.body, node.orelse]
+node.children = [node.test, node.body]
+assert node.orelse is None and len(node.children) == 2
+assert Parse('a.b', '<test>').children[0].owner == Node('Name', 'a', [])
+assert Node('Unknown', 1, []) != Node('Other', 1, [])
+
+FLAT_PROGRAM = """
+var x = 1
+if x
+  "a".Print()
+else
+  f(x, [2, x])
+"""
+tree = Parse(FLAT_PROGRAM, '<test>', flat=True)
+assert tree.Node() == Parse(FLAT_PROGRAM, '<test>')
+assert [tree.Type(i) for i in tree.Children(0)] == ['var', 'if']
+assert tree.Origin(0).LineNumber() == 2
+assert tree.Format().startswith("Module\n  var ['x']\n    Number 1\n  if\n    Name 'x'\n"), tree.Format()
+assert FlatTree.FromBytes(tree.ToBytes(), tree.source).Node() == tree.Node()
+assert Parse('', '<test>', flat=True).Node() == Parse('', '<test>')
+
+PROFILE_PROGRAM = r"""
+var Count = \ n
+  if n.Equal(0)
+    return 0
+  Count(n.Subtract(1))
+Count(3)
+Assert(true)
+"""
+profiler = Profiler()
+assert profiler.Run(PROFILE_PROGRAM, '<test>') == nil
+assert Evaluate is MODES['evaluate']
+assert profiler.functions['<test>', 2, 'Count'][:2] == [4, 1]
+assert profiler.functions['~', 0, 'Number.Subtract'][0] == 3
+assert profiler.functions['~', 0, 'Assert'][0] == 1
+assert profiler.lines['<test>', 3] == 4 and profiler.lines['<test>', 4] == 1
+assert profiler.Stats()['<test>', 2, 'Count'][4]['<test>', 0, '<module>'][0] == 1
+assert all(line.startswith('<test>:0(<module>)') for line in profiler.FlameGraph().splitlines())
+assert profiler.Report().splitlines()[0].split() == ['calls', 'total', 's', 'own', 's', 'function']
+
+SAMPLE_PROGRAM = r"""
+var Inner = \
+  Sample()
+  nil
+var Outer = \
+  Inner()
+  nil
+Outer()
+"""
+sampler = Sampler()
+for mode in MODES:
+  stacks = []
+  scope = Scope(ROOT_SCOPE)
+  scope.Declare('Sample', BuiltinFunction(lambda: stacks.append(sampler.Stack(sys._getframe()))))
+  node = Parse(SAMPLE_PROGRAM, '<test>')
+  sampler.names = FunctionNames(node)
+  MODES[mode](scope, node)
+  assert stacks == [('<unknown>:0(<module>)', '<test>:5(Outer)', '<test>:2(Inner)')], (mode, stacks)
+
+sampler = Sampler(0.001)
+sampler.Run(SAMPLE_PROGRAM.replace('Sample()', 'nil'), '<test>', 'vm')
+assert sampler.thread is None
+assert all(line.startswith('<test>:0(<module>)') for line in sampler.FlameGraph().splitlines())
+
+COVERAGE_PROGRAM = r"""
+var i = 0
+while i.LessThan(3)
+  i = i.Add(1)
+if i.Equal(5)
+  i.Print()
+"""
+coverage = Coverage()
+coverage.Run(COVERAGE_PROGRAM, '<test>')
+coverage.Run(COVERAGE_PROGRAM, '<test>')
+assert coverage.Json() == {'<test>': {'2': 2, '3': 2, '4': 6, '5': 2, '6': 0}}, coverage.Json()
+assert coverage.Report().splitlines()[0] == '<test>: 4 of 5 lines run'
+assert '>>>>>>    i.Print()' in coverage.Report()
+try:
+  coverage.Run('break', '<test>')
+except CclError as e:
+  assert e.message == 'break outside of while', e.message
+else:
+  assert False, "break outside of while should have raised error"
+
+# Optimizing runs no line that did not run before. Only the lines of ifs
+# on constants, which are replaced by the branch taken, stop counting.
+lines = []
+for passes in ((), PASSES):
+  coverage = Coverage()
+  with contextlib.redirect_stdout(io.StringIO()):
+    coverage.Run(OPTIMIZER_PROGRAM, '<test>', passes=passes)
+  lines.append(set(line for line, hits in coverage.Json()['<test>'].items() if hits))
+assert lines[1] <= lines[0] and lines[0] - lines[1] == set(['5', '8']), lines
+
+stats = Stats()
+assert stats.Run('var x = (1).Add(2)\nx.Add(x)', '<test>') == 6
+assert [phase.name for phase in stats.phases] == ['lex', 'parse', 'optimize', 'compile', 'run']
+assert stats.phases[0].count == len(Lex('var x = (1).Add(2)\nx.Add(x)', '<test>'))
+assert [phase.count for phase in stats.phases[1:3]] == [10, 7], [phase.count for phase in stats.phases]
+assert all(phase.peak >= 0 and phase.seconds >= 0 for phase in stats.phases)
+assert stats.Report().splitlines()[0].split()[-2:] == ['net', 'blocks']
+assert stats.Report().splitlines()[-1].startswith('total')
+assert not tracemalloc.is_tracing()
+stats = Stats(memory=False)
+assert stats.Run('(2).Add(3)', '<test>', 'vm') == 5
+assert [phase.name for phase in stats.phases] == ['lex', 'parse', 'optimize', 'assemble', 'run']
+assert stats.phases[-1].peak is None
+for mode in MODES:
+  try:
+    Stats(memory=False).Run('break', '<test>', mode)
+  except CclError as e:
+    assert e.message == 'break outside of while', (mode, e.message)
+  else:
+    assert False, "break outside of while should have raised error"
+
+ROOT_SCOPE.table.clear()
+ROOT_SCOPE.table.update(root_table)
+del root_table
+
 ### Main
 
 if __name__ == '__main__':
-  RunX(sys.stdin.read(), '<stdin>')
+  import argparse
+  parser = argparse.ArgumentParser(description='Run a ccl program read from stdin.')
+  parser.add_argument('--mode', choices=sorted(MODES), default='compile')
+  parser.add_argument('--dis', action='store_true', help='print bytecode instead of running')
+  parser.add_argument('--tree', action='store_true', help='print the parsed tree instead of running')
+  parser.add_argument('--cache', metavar='DIRECTORY', help='reuse parsed programs saved in DIRECTORY')
+  parser.add_argument('--disable', action='append', default=[], choices=PASSES,
+                      help='skip an optimizer pass')
+  # Each of these runs the program its own way, so only one can be used.
+  runs = parser.add_mutually_exclusive_group()
+  runs.add_argument('--profile', action='store_true',
+                    help='run in evaluate mode and print a profile to stderr')
+  parser.add_argument('--pstats', metavar='FILE', help='write a profile for pstats to FILE')
+  parser.add_argument('--flamegraph', metavar='FILE',
+                      help='write a profile as collapsed stacks to FILE')
+  runs.add_argument('--sample', metavar='FILE',
+                    help='write collapsed stacks sampled while running to FILE')
+  parser.add_argument('--sample-interval', metavar='SECONDS', type=float, default=0.005)
+  runs.add_argument('--coverage', metavar='FILE',
+                    help='run in compile mode and write line hits as JSON to FILE')
+  parser.add_argument('--coverage-report', metavar='FILE',
+                      help='run in compile mode and write the source annotated with hits to FILE')
+  runs.add_argument('--stats', action='store_true',
+                    help='print the time, memory and net change in allocated blocks '
+                         'of each phase of the run to stderr')
+  args = parser.parse_args()
+  passes = [name for name in PASSES if name not in args.disable]
+  profiler = Profiler() if args.profile or args.pstats or args.flamegraph else None
+  sampler = Sampler(args.sample_interval) if args.sample else None
+  coverage = Coverage() if args.coverage or args.coverage_report else None
+  stats = Stats() if args.stats else None
+  # --pstats, --flamegraph and --coverage-report go with --profile or
+  # --coverage, so the group cannot check them.
+  if sum(run is not None for run in (profiler, sampler, coverage, stats)) > 1:
+    parser.error('only one of profiling, sampling, coverage and stats can be used at a time')
+
+  if args.tree:
+    sys.stdout.write(Parse(sys.stdin, '<stdin>', flat=True).Format())
+  elif args.dis:
+    node = Optimize(Parse(sys.stdin, '<stdin>'), passes)
+    sys.stdout.write(Disassemble(Assemble(node, FrameLayout(None, (), node, ROOT_SCOPE))))
+  else:
+    if profiler is not None:
+      mode, run = 'evaluate', profiler.Run
+    elif sampler is not None:
+      mode, run = args.mode, sampler.Run
+    elif coverage is not None:
+      mode, run = 'compile', coverage.Run
+    elif stats is not None:
+      mode, run = args.mode, stats.Run
+    else:
+      mode, run = args.mode, Run
+    try:
+      RunX(sys.stdin, '<stdin>', mode, args.cache, passes, run)
+    finally:
+      if args.stats:
+        sys.stderr.write(stats.Report())
+      if args.coverage:
+        coverage.Dump(args.coverage)
+      if args.coverage_report:
+        with open(args.coverage_report, 'w') as f:
+          f.write(coverage.Report())
+      if args.sample:
+        with open(args.sample, 'w') as f:
+          f.write(sampler.FlameGraph())
+      if args.profile:
+        sys.stderr.write(profiler.Report())
+      if args.pstats:
+        profiler.DumpStats(args.pstats)
+      if args.flamegraph:
+        with open(args.flamegraph, 'w') as f:
+          f.write(profiler.FlameGraph())